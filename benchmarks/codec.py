@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Time saving and loading a generated database of N records through
+CodecStorage, for each installed codec and file layout.
+
+    python benchmarks/codec.py [N]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+from taxonopy.codec import get_codec
+from taxonopy.db import CodecStorage
+from taxonopy.schema import SCHTree
+
+RECORDS = 50000
+LAYOUTS = [("json", True),
+           ("json", False),
+           ("orjson", False),
+           ("ujson", False)]
+
+
+def make_record(i):
+    
+    record = SCHTree()
+    record.add_node("Name", type="str", value=f"Record {i}")
+    record.add_node("Colour", "Name", inquire="list")
+    record.add_node("Blue" if i % 2 else "Black", "Name/Colour")
+    record.add_node("Features", "Name", inquire="checkbox")
+    record.add_node("Defrost", "Name/Features")
+    record.add_node("Reheat", "Name/Features")
+    
+    return record
+
+
+def main(n_records):
+    
+    data = {"_default": {str(i): make_record(i).to_dict()
+                                            for i in range(1, n_records + 1)}}
+    
+    print(f"{'codec':<8} {'layout':<10} {'save':>8} {'load':>8} {'size':>9}")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        
+        for codec, pretty in LAYOUTS:
+            
+            # Codecs that are not installed are skipped
+            try:
+                get_codec(codec)
+            except ValueError:
+                continue
+            
+            path = os.path.join(tmp_dir, f"{codec}-{pretty}.json")
+            storage = CodecStorage(path, codec=codec, pretty=pretty)
+            
+            start = time.perf_counter()
+            storage.write(data)
+            save = time.perf_counter() - start
+            
+            storage.close()
+            
+            # CodecStorage reuses the data it last wrote, so loading is
+            # timed by parsing the file directly
+            start = time.perf_counter()
+            with open(path, encoding="utf-8") as f:
+                get_codec(codec).loads(f.read())
+            load = time.perf_counter() - start
+            
+            layout = "indented" if pretty else "compact"
+            size = os.path.getsize(path) / 1e6
+            
+            print(f"{codec:<8} {layout:<10} {save:>7.2f}s {load:>7.2f}s "
+                  f"{size:>7.1f}MB")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else RECORDS)
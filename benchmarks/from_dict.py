@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Time building trees from dictionaries, using the toaster example schema
+with its branches repeated N times, and reading the toaster example
+database as records.
+
+    python benchmarks/from_dict.py [N]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+from taxonopy.db import JSONDataBase
+from taxonopy.schema import SCHTree
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(__file__),
+                           "..",
+                           "examples",
+                           "toasters")
+COPIES = 600
+REPEATS = 5
+
+
+def scale_schema(data, copies):
+    
+    scaled = {"L0": data["L0"]}
+    
+    # Each first level branch is repeated under a numbered name
+    for level in sorted(key for key in data if key != "L0"):
+        
+        nodes = []
+        
+        for i in range(copies):
+            for node in data[level]:
+                
+                node = dict(node)
+                parts = node["parent"].split("/")
+                
+                if level == "L1":
+                    node["name"] = f"{node['name']} {i}"
+                else:
+                    parts[1] = f"{parts[1]} {i}"
+                
+                node["parent"] = "/".join(parts)
+                nodes.append(node)
+        
+        scaled[level] = nodes
+    
+    return scaled
+
+
+def main(copies):
+    
+    with open(os.path.join(EXAMPLE_DIR, "schema.json"),
+              encoding="utf-8") as f:
+        data = json.load(f)
+    
+    scaled = scale_schema(data, copies)
+    n_nodes = sum(len(nodes) for nodes in scaled.values())
+    
+    start = time.perf_counter()
+    for _ in range(REPEATS): SCHTree.from_dict(scaled)
+    elapsed = (time.perf_counter() - start) / REPEATS
+    
+    print(f"from_dict, {n_nodes} nodes: {elapsed:.3f}s")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        
+        db_path = os.path.join(tmp_dir, "db.json")
+        shutil.copy(os.path.join(EXAMPLE_DIR, "db.json"), db_path)
+        
+        with JSONDataBase(db_path) as db:
+            
+            start = time.perf_counter()
+            for _ in range(20): db.to_records()
+            elapsed = time.perf_counter() - start
+    
+    print(f"to_records on the toaster example, 20 times: {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else COPIES)
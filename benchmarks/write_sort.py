@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Time the ordering of documents on write, with and without
+WriteSortMiddleware, for the toaster example replicated to N documents.
+
+    python benchmarks/write_sort.py [N ...]
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+
+from tinydb.storages import MemoryStorage
+
+from taxonopy.db import WriteSortMiddleware, _order_data
+
+EXAMPLE_DB = os.path.join(os.path.dirname(__file__),
+                          "..",
+                          "examples",
+                          "toasters",
+                          "db.json")
+SIZES = [1000, 5000, 20000]
+
+
+def main(sizes):
+    
+    with open(EXAMPLE_DB, encoding="utf-8") as f:
+        docs = list(json.load(f)["_default"].values())
+    
+    print(f"{'N':>8} {'_order_data(data)':>20} {'incremental write':>20}")
+    
+    for n in sizes:
+        
+        table = {str(i): copy.deepcopy(docs[i % len(docs)])
+                                                    for i in range(1, n + 1)}
+        data = {"_default": table}
+        
+        middleware = WriteSortMiddleware(MemoryStorage)()
+        middleware.write(data)
+        
+        # Insert one more document and write the table again
+        table[str(n + 1)] = copy.deepcopy(docs[0])
+        
+        start = time.perf_counter()
+        expected = _order_data(data)
+        full = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        middleware.write(data)
+        incremental = time.perf_counter() - start
+        
+        assert middleware.storage.memory == expected
+        
+        print(f"{n:>8} {full:>19.3f}s {incremental * 1000:>18.1f}ms")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -121,22 +121,29 @@ def _db_new(parser,context,topargs):
                         help='path to the schema (default is ./schema.json)',
                         action="store",
                         default="schema.json")
+    parser.add_argument('--journal',
+                        help=('append changes to the database journal '
+                              '(see "db compact")'),
+                        action="store_true")
     
     args = parser.parse_args(topargs)
     
     from .db import new_record
-    from ..db import JSONDataBase
+    from ..db import open_database
     from ..schema import SCHTree
     
     try:
-        db = JSONDataBase(args.db, check_existing=True)
+        schema = SCHTree.from_json(args.schema)
     except IOError:
-        print("Database not found")
+        print("Schema not found")
     
     try:
-        schema = SCHTree.from_json(args.schema)
+        db = open_database(args.db,
+                           check_existing=True,
+                           journal=args.journal,
+                           schema=schema)
     except IOError:
-        print("Schema not found")
+        print("Database not found")
     
     new_record(schema, db)
 
@@ -150,13 +157,18 @@ def _db_update(parser,context,topargs):
     
     parser.add_argument('path',
                         help='path of field to search',
-                        action="store")
+                        action="store",
+                        nargs="?")
     parser.add_argument('--value',
                         help='only show records with matching field value',
                         action="store")
     parser.add_argument('--exact',
                         help='only show exact value matches',
                         action="store_true")
+    parser.add_argument('--where',
+                        help=('only include records matching the query, e.g. '
+                              '"Title/Colour/Blue & !Title/Features/Defrost"'),
+                        action="store")
     parser.add_argument('--field',
                         help='only update the given field',
                         action="store")
@@ -168,29 +180,40 @@ def _db_update(parser,context,topargs):
                         help='path to the schema (default is ./schema.json)',
                         action="store",
                         default="schema.json")
+    parser.add_argument('--journal',
+                        help=('append changes to the database journal '
+                              '(see "db compact")'),
+                        action="store_true")
     
     args = parser.parse_args(topargs)
     
     from .db import update_records
-    from ..db import JSONDataBase
+    from ..db import open_database
     from ..schema import SCHTree
     
     try:
-        db = JSONDataBase(args.db, check_existing=True)
+        schema = SCHTree.from_json(args.schema)
     except IOError:
-        print("Database not found")
+        print("Schema not found")
     
     try:
-        schema = SCHTree.from_json(args.schema)
+        db = open_database(args.db,
+                           check_existing=True,
+                           journal=args.journal,
+                           schema=schema)
     except IOError:
-        print("Schema not found")
+        print("Database not found")
     
-    update_records(args.path,
-                   schema,
-                   db,
-                   args.value,
-                   args.exact,
-                   args.field)
+    try:
+        update_records(args.path,
+                       schema,
+                       db,
+                       args.value,
+                       args.exact,
+                       args.field,
+                       args.where)
+    except ValueError as e:
+        print(e)
 
 
 @subcmd('equal',
@@ -199,7 +222,7 @@ def _db_update(parser,context,topargs):
         help="test equality of two database files")
 def _db_equal(parser,context,topargs):
     
-    from ..db import JSONDataBase
+    from ..db import open_database
     from ..utils import load_xl
     
     def load_db_records(db_path, schema, strict):
@@ -207,8 +230,8 @@ def _db_equal(parser,context,topargs):
         db_name, db_extension = os.path.splitext(db_path)
         
         if db_extension not in [".xlsx", ".xls"]:
-            with JSONDataBase(db_path, check_existing=True) as db:
-                return db.to_records()
+            with open_database(db_path, check_existing=True) as db:
+                return db.to_views()
         
         with tempfile.TemporaryDirectory() as tmpdirname:
         
@@ -221,8 +244,8 @@ def _db_equal(parser,context,topargs):
                     strict=strict,
                     progress=True)
             
-            with JSONDataBase(db_temppath, check_existing=True) as db:
-                return db.to_records()
+            with open_database(db_temppath, check_existing=True) as db:
+                return db.to_views()
     
     parser.add_argument('db_one',
                         help='path to first database (json or Excel)',
@@ -238,6 +261,11 @@ def _db_equal(parser,context,topargs):
     parser.add_argument('--strict',
                         help=('values must conform to the schema'),
                         action="store_true")
+    parser.add_argument('--workers',
+                        help=('number of processes used to compare large '
+                              'databases (default is one)'),
+                        action="store",
+                        type=int)
     
     args = parser.parse_args(topargs)
     
@@ -260,7 +288,8 @@ def _db_equal(parser,context,topargs):
         print("Second database not found")
     
     missing = find_non_matching_records(records_one,
-                                        records_two)
+                                        records_two,
+                                        args.workers)
     
     if not missing:
         print("Databases are equal")
@@ -288,15 +317,24 @@ def _db_validate(parser,context,topargs):
                         help='path to the schema (default is ./schema.json)',
                         action="store",
                         default="schema.json")
+    parser.add_argument('--where',
+                        help=('only include records matching the query, e.g. '
+                              '"Title/Colour/Blue & !Title/Features/Defrost"'),
+                        action="store")
+    parser.add_argument('--workers',
+                        help=('number of processes used to check large '
+                              'databases (default is one)'),
+                        action="store",
+                        type=int)
     
     args = parser.parse_args(topargs)
     
-    from ..db import JSONDataBase
+    from ..db import open_database
     from ..schema import SCHTree
     from ..utils import find_non_matching_nodes
     
     try:
-        db = JSONDataBase(args.db, check_existing=True)
+        db = open_database(args.db, check_existing=True)
     except IOError:
         print("Database not found")
     
@@ -305,7 +343,14 @@ def _db_validate(parser,context,topargs):
     except IOError:
         print("Schema not found")
     
-    result = find_non_matching_nodes(db, schema)
+    try:
+        result = find_non_matching_nodes(db,
+                                         schema,
+                                         args.where,
+                                         args.workers)
+    except ValueError as e:
+        print(e)
+        return
     
     if result:
         result_str = yaml.dump(result, Dumper=MyDumper, default_flow_style=False)
@@ -323,13 +368,18 @@ def _db_count(parser,context,topargs):
     
     parser.add_argument('path',
                         help='path of field to count',
-                        action='store')
+                        action='store',
+                        nargs="?")
     parser.add_argument('--value',
                         help='only matching given value',
                         action="store")
     parser.add_argument('--exact',
                         help='only show exact value matches',
                         action="store_true")
+    parser.add_argument('--where',
+                        help=('only include records matching the query, e.g. '
+                              '"Title/Colour/Blue & !Title/Features/Defrost"'),
+                        action="store")
     parser.add_argument('--db',
                         help='path to the database (default is ./db.json)',
                         action="store",
@@ -337,16 +387,22 @@ def _db_count(parser,context,topargs):
     
     args = parser.parse_args(topargs)
     
-    from ..db import JSONDataBase, make_query
+    from ..db import make_query, open_database
     
     try:
-        db = JSONDataBase(args.db, check_existing=True)
+        db = open_database(args.db, check_existing=True)
     except IOError:
         print("Database not found")
     
-    query = make_query(args.path, args.value, args.exact)
+    try:
+        query = make_query(args.path, args.value, args.exact, args.where)
+    except ValueError as e:
+        print(e)
+        return
+    
     count = db.count(query)
-    msg = f"{args.path}: {count}"
+    title = " & ".join(x for x in (args.path, args.where) if x is not None)
+    msg = f"{title}: {count}"
     print(msg)
 
 
@@ -362,6 +418,10 @@ def _db_choices(parser,context,topargs):
     parser.add_argument('--csv',
                         help='save results to csv file at given path',
                         action="store")
+    parser.add_argument('--where',
+                        help=('only include records matching the query, e.g. '
+                              '"Title/Colour/Blue & !Title/Features/Defrost"'),
+                        action="store")
     parser.add_argument('--db',
                         help='path to the database (default is ./db.json)',
                         action="store",
@@ -373,12 +433,12 @@ def _db_choices(parser,context,topargs):
     
     args = parser.parse_args(topargs)
     
-    from ..db import JSONDataBase
+    from ..db import open_database
     from ..schema import SCHTree
     from ..utils import choice_count
     
     try:
-        db = JSONDataBase(args.db, check_existing=True)
+        db = open_database(args.db, check_existing=True)
     except IOError:
         print("Database not found")
     
@@ -388,9 +448,12 @@ def _db_choices(parser,context,topargs):
         print("Schema not found")
     
     try:
-        count = choice_count(args.path, db, schema)
+        count = choice_count(args.path, db, schema, args.where)
     except IOError:
         print("Database not found")
+    except ValueError as e:
+        print(e)
+        return
     
     msg = (f"{k}: {v}" for k, v in count.items())
     print('\n'.join(msg))
@@ -417,13 +480,18 @@ def _db_show(parser,context,topargs):
     
     parser.add_argument('path',
                         help='path of field to search',
-                        action="store")
+                        action="store",
+                        nargs="?")
     parser.add_argument('--value',
                         help='only show records with matching field value',
                         action="store")
     parser.add_argument('--exact',
                         help='only show exact value matches',
                         action="store_true")
+    parser.add_argument('--where',
+                        help=('only include records matching the query, e.g. '
+                              '"Title/Colour/Blue & !Title/Features/Defrost"'),
+                        action="store")
     parser.add_argument('--db',
                         help='path to the database (default is ./db.json)',
                         action="store",
@@ -431,17 +499,20 @@ def _db_show(parser,context,topargs):
     
     args = parser.parse_args(topargs)
     
-    from ..db import JSONDataBase, make_query
+    from ..db import make_query, open_database
     
     try:
-        db = JSONDataBase(args.db, check_existing=True)
+        db = open_database(args.db, check_existing=True)
     except IOError:
         print("Database not found")
     
-    query = make_query(args.path, args.value, args.exact)
-    db = db.search(query)
+    try:
+        query = make_query(args.path, args.value, args.exact, args.where)
+    except ValueError as e:
+        print(e)
+        return
     
-    for record in db.to_records().values():
+    for _, record in db.iter_records(query):
         print(record)
 
 
@@ -454,6 +525,10 @@ def _db_list(parser,context,topargs):
     parser.add_argument('--path',
                         help='path of field to display (default is root)',
                         action='append')
+    parser.add_argument('--where',
+                        help=('only include records matching the query, e.g. '
+                              '"Title/Colour/Blue & !Title/Features/Defrost"'),
+                        action="store")
     parser.add_argument('--db',
                         help='path to the database (default is ./db.json)',
                         action="store",
@@ -462,17 +537,19 @@ def _db_list(parser,context,topargs):
     args = parser.parse_args(topargs)
     
     from .db import show_nodes
-    from ..db import JSONDataBase
+    from ..db import open_database
     
     try:
-        db = JSONDataBase(args.db, check_existing=True)
+        db = open_database(args.db, check_existing=True)
     except IOError:
         print("Database not found")
     
     try:
-        show_nodes(args.path, db)
+        show_nodes(args.path, db, where=args.where)
     except IOError:
         print("Database not found")
+    except ValueError as e:
+        print(e)
 
 
 @subcmd('flush',
@@ -485,19 +562,105 @@ def _db_flush(parser,context,topargs):
                         help='path to the database (default is ./db.json)',
                         action="store",
                         default="db.json")
+    parser.add_argument('--schema',
+                        help='path to the schema (default is ./schema.json)',
+                        action="store",
+                        default="schema.json")
+    
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--referenced',
+                       help=('store records as references to the schema, '
+                             'without copies of the schema attributes'),
+                       action="store_true")
+    group.add_argument('--verbose',
+                       help='store full copies of the schema attributes',
+                       action="store_true")
+    parser.add_argument('--pretty',
+                        help='write an indented, human readable JSON file',
+                        action="store_true")
     
     args = parser.parse_args(topargs)
     
-    from ..db import JSONDataBase
+    from ..db import open_database
+    from ..schema import SCHTree
+    
+    kwargs = {}
+    
+    if args.referenced:
+        
+        try:
+            schema = SCHTree.from_json(args.schema)
+        except IOError:
+            print("Schema not found")
+            return
+        
+        kwargs = {"schema": schema, "referenced": True}
+    
+    elif args.verbose:
+        
+        kwargs = {"referenced": False}
+    
+    if args.pretty: kwargs["pretty"] = True
     
     try:
-        db = JSONDataBase(args.db)
+        db = open_database(args.db, **kwargs)
         db.flush()
         db.close()
     except IOError:
         print("Database not found")
 
 
+@subcmd('compact',
+        dbcommands,
+        dbcommands_help,
+        help="fold the database journal into the database file")
+def _db_compact(parser,context,topargs):
+    
+    parser.add_argument('--db',
+                        help='path to the database (default is ./db.json)',
+                        action="store",
+                        default="db.json")
+    
+    args = parser.parse_args(topargs)
+    
+    from ..db import open_database
+    
+    try:
+        db = open_database(args.db, check_existing=True)
+    except IOError:
+        print("Database not found")
+        return
+    
+    db.compact()
+    db.close()
+
+
+@subcmd('convert',
+        dbcommands,
+        dbcommands_help,
+        help="convert database between json and sqlite formats")
+def _db_convert(parser,context,topargs):
+    
+    parser.add_argument('src',
+                        help='path to the database to convert',
+                        action="store")
+    parser.add_argument('dst',
+                        help=('path to the new database (use the .sqlite '
+                              'extension for sqlite)'),
+                        action="store")
+    
+    args = parser.parse_args(topargs)
+    
+    from ..db import convert_database
+    
+    try:
+        convert_database(args.src, args.dst)
+    except IOError:
+        print("Database not found")
+    except ValueError:
+        print("Destination database is not empty")
+
+
 @subcmd('dump',
         dbcommands,
         dbcommands_help,
@@ -515,15 +678,19 @@ def _db_dump(parser,context,topargs):
                         help='path to the schema (default is ./schema.json)',
                         action="store",
                         default="schema.json")
+    parser.add_argument('--where',
+                        help=('only include records matching the query, e.g. '
+                              '"Title/Colour/Blue & !Title/Features/Defrost"'),
+                        action="store")
     
     args = parser.parse_args(topargs)
     
-    from ..db import JSONDataBase
+    from ..db import open_database
     from ..schema import SCHTree
     from ..utils import dump_xl
     
     try:
-        db = JSONDataBase(args.db, check_existing=True)
+        db = open_database(args.db, check_existing=True)
     except IOError:
         print("Database not found")
     
@@ -533,9 +700,11 @@ def _db_dump(parser,context,topargs):
         print("Schema not found")
     
     try:
-        dump_xl(args.path, schema, db)
+        dump_xl(args.path, schema, db, where=args.where)
     except PermissionError:
         print("Can not write to open file")
+    except ValueError as e:
+        print(e)
 
 
 @subcmd('load',
@@ -558,6 +727,10 @@ def _db_load(parser,context,topargs):
                         help=('ignore values that do no conform to the '
                               'schema'),
                         action="store_true")
+    parser.add_argument('--journal',
+                        help=('append changes to the database journal '
+                              '(see "db compact")'),
+                        action="store_true")
     
     args = parser.parse_args(topargs)
     strict = not args.force
@@ -574,7 +747,8 @@ def _db_load(parser,context,topargs):
             args.xl_path,
             schema,
             strict,
-            progress=True)
+            progress=True,
+            journal=args.journal)
 
 
 ### SCHEMA CLI
@@ -681,6 +855,55 @@ def _schema_document(parser,context,topargs):
     if msgs: print("\n".join(msgs))
 
 
+@subcmd('diff',
+        schemacommands,
+        schemacommands_help,
+        help="show the differences between two schemas")
+def _schema_diff(parser,context,topargs):
+    
+    parser.add_argument('schema_one',
+                        help='path to the first schema',
+                        action="store")
+    parser.add_argument('schema_two',
+                        help='path to the second schema',
+                        action="store")
+    
+    args = parser.parse_args(topargs)
+    
+    from ..schema import SCHTree
+    
+    if not os.path.isfile(args.schema_one):
+        print("First schema not found")
+        return
+    
+    if not os.path.isfile(args.schema_two):
+        print("Second schema not found")
+        return
+    
+    schema_one = SCHTree.from_json(args.schema_one)
+    schema_two = SCHTree.from_json(args.schema_two)
+    
+    diff = schema_one.diff(schema_two, detail=True)
+    
+    if not diff:
+        print("Schemas are equal")
+        return
+    
+    for path, (change, attrs) in diff.items():
+        
+        print(f"{change}: {path}")
+        
+        if not attrs: continue
+        
+        node_one = schema_one.find_by_path(path)
+        node_two = schema_two.find_by_path(path)
+        
+        for attr in attrs:
+            value_one = getattr(node_one, attr, None)
+            value_two = getattr(node_two, attr, None)
+            print(f"    {attr}: {value_one} -> {value_two}")
+
+
 @subcmd('new',
         schemacommands,
         schemacommands_help,
@@ -788,8 +1011,7 @@ def _schema_add(parser,context,topargs):
     total_path = f"{args.parent}/{args.name}"
     
     try: 
-        node = schema.find_by_path(total_path)
-        node.parent = None
+        schema.delete_node(total_path)
     except ChildResolverError:
         pass
     
@@ -8,17 +8,13 @@ from inquirer.render.console import ConsoleRender
 
 from . import CLITheme
 from .schema import CLIRecordBuilder
-from ..db import _is_iterable, make_query
-from ..utils import get_root_value_ids
+from ..db import _is_iterable, get_record_props, make_query
 
 
 def new_record(schema, db):
     
-    root_value_ids = get_root_value_ids(db)
-    
     builder = CLIRecordBuilder(schema)
     record = None
-    doc_id = None
     
     while True:
         
@@ -31,9 +27,8 @@ def new_record(schema, db):
         node = record.root_node
         print(record)
         
-        if node.value in root_value_ids:
+        if db.has_key(node.value):
             message = "Replace "
-            doc_id = root_value_ids[node.value]
         else:
             message = "Store "
         
@@ -52,11 +47,7 @@ def new_record(schema, db):
         if choice == "quit": return
         if choice == "retry": continue
         
-        if doc_id is None:
-            db.insert(record)
-        else:
-            db.replace(doc_id, record)
-        
+        db.upsert_many([record])
         db.close()
         
         return
@@ -67,14 +58,15 @@ def update_records(path,
                    db,
                    value=None,
                    exact=False,
-                   node_path=None):
+                   node_path=None,
+                   where=None):
     
     builder = CLIRecordBuilder(schema)
     
-    query = make_query(path, value, exact)
-    memdb = db.search(query)
+    query = make_query(path, value, exact, where)
+    result = db.search(query)
     
-    for doc_id, record in memdb.to_records().items():
+    for doc_id, record in result.to_records().items():
         
         node = record.root_node
         message = f"Update record with {node.name} '{node.value}'?"
@@ -127,7 +119,7 @@ def update_records(path,
     db.close()
 
 
-def show_nodes(paths, db, max_col_width=50):
+def show_nodes(paths, db, max_col_width=50, where=None):
     
     def _get_msg(attrs):
         
@@ -148,15 +140,17 @@ def show_nodes(paths, db, max_col_width=50):
     if not _is_iterable(paths):
         paths = (paths,)
     
-    records = db.projection(paths)
+    query = None
+    if where is not None: query = make_query(where=where)
+    
     msg_rows = []
     
-    for record in zip(*records.values()):
+    for _, record in db.iter_records(query, paths=paths, view=True):
         
         msgs = []
         
-        for i, _ in enumerate(paths):
-            msgs.append(_get_msg(record[i+1]))
+        for path in paths:
+            msgs.append(_get_msg(get_record_props(record, path)))
         
         if set(msgs) == set([None]):
             continue
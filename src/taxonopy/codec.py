@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JSONCodec:
+    
+    name = "json"
+    
+    def loads(self, text):
+        return json.loads(text)
+    
+    def dumps(self, data, pretty=False):
+        
+        # Human readable output always uses the standard library, so that
+        # the layout does not depend on the installed packages
+        if pretty: return json.dumps(data, indent=4, separators=(',', ': '))
+        
+        return self._dumps(data)
+    
+    def _dumps(self, data):
+        return json.dumps(data, separators=(',', ':'))
+
+
+class OrJSONCodec(JSONCodec):
+    
+    name = "orjson"
+    
+    def loads(self, text):
+        return orjson.loads(text)
+    
+    def _dumps(self, data):
+        return orjson.dumps(data).decode("utf-8")
+
+
+class UJSONCodec(JSONCodec):
+    
+    name = "ujson"
+    
+    def loads(self, text):
+        return ujson.loads(text)
+    
+    def _dumps(self, data):
+        return ujson.dumps(data, ensure_ascii=False)
+
+
+def get_codec(name=None):
+    
+    codecs = {}
+    if orjson is not None: codecs[OrJSONCodec.name] = OrJSONCodec
+    if ujson is not None: codecs[UJSONCodec.name] = UJSONCodec
+    codecs[JSONCodec.name] = JSONCodec
+    
+    if name is None: return next(iter(codecs.values()))()
+    
+    if name not in codecs:
+        raise ValueError(f"JSON codec '{name}' is not available")
+    
+    return codecs[name]()
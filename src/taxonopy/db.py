@@ -1,203 +1,1785 @@
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import abc
+import json
+import bisect
+import hashlib
+import sqlite3
 from collections import OrderedDict
 from collections.abc import ByteString, Iterable, Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
 
+from anytree import PreOrderIter
 from anytree.resolver import ChildResolverError
-from natsort import natsorted
-from tinydb import table, TinyDB, Query
+from natsort import natsort_keygen, natsorted
+from tinydb import table, TinyDB
 from tinydb.middlewares import CachingMiddleware, Middleware
-from tinydb.storages import JSONStorage, MemoryStorage
+from tinydb.storages import JSONStorage, MemoryStorage, Storage
 
-from .schema import SCHTree, get_node_attr
+from .codec import get_codec
+from .lock import FileLock
+from .index import (BitmapIndex,
+                    KeyIndex,
+                    PathIndex,
+                    SortIndex,
+                    ValueIndex,
+                    get_doc_key,
+                    get_doc_node_path,
+                    normalize_path,
+                    to_bitmap)
+from .query import (AndQuery,
+                    IdQuery,
+                    IndexedQuery,
+                    NodeQuery,
+                    QueryCache,
+                    compare_values,
+                    parse_query)
+from .schema import (SCH_ATTRS,
+                     RecordView,
+                     SCHTree,
+                     get_node_attr,
+                     get_node_path)
+
+SQLITE_EXTENSIONS = [".sqlite", ".sqlite3"]
+SCHEMAS_TABLE = "_schemas"
+SCHEMA_KEY = "_schema"
+MISSING_KEY = "_missing"
+VERSIONS_PREFIX = "_versions:"
+READ_CACHE_SIZE = 4
+SHARDS_META = "shards.json"
+SHARDS_LOCK = "shards.lock"
+DEFAULT_SHARDS = 16
+PARALLEL_READ_SIZE = 16 * 2 ** 20
+PARALLEL_MIN_RECORDS = 2000
+PARALLEL_CHUNK_SIZE = 250
+READ_CHUNK_SIZE = 100
+
+_natsort_key = natsort_keygen()
+_read_cache = OrderedDict()
+
+
+class ConflictError(ValueError):
+    pass
+
+
+class CodecStorage(JSONStorage):
+    
+    def __init__(self, path, codec=None, pretty=False, **kwargs):
+        super(CodecStorage, self).__init__(path, encoding="utf-8", **kwargs)
+        self._codec = get_codec(codec)
+        self._pretty = pretty
+        self._key = os.path.realpath(path)
+    
+    def read(self):
+        
+        self._handle.seek(0)
+        text = self._handle.read()
+        if not text: return None
+        
+        # Reopening an unchanged file reuses the last parsed data. The
+        # contents are compared, as a change of the same size can keep
+        # the modification time
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        cached = _read_cache.get(self._key)
+        
+        if cached is not None and cached[0] == digest:
+            data = cached[1]
+        else:
+            data = self._codec.loads(text)
+        
+        self._cache(digest, data)
+        
+        return _copy_tables(data)
+    
+    def write(self, data):
+        
+        serialized = self._codec.dumps(data, pretty=self._pretty)
+        self._handle.seek(0)
+        
+        try:
+            self._handle.write(serialized)
+        except io.UnsupportedOperation:
+            raise IOError("Cannot write to the database. Access mode is "
+                          f"'{self._mode}'")
+        
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self._handle.truncate()
+        
+        self._cache(hashlib.sha1(serialized.encode("utf-8")).digest(),
+                    _copy_tables(data))
+    
+    def _cache(self, digest, data):
+        
+        _read_cache[self._key] = (digest, data)
+        _read_cache.move_to_end(self._key)
+        
+        while len(_read_cache) > READ_CACHE_SIZE:
+            _read_cache.popitem(last=False)
+
+
+class SnapshotStorage(Storage):
+    
+    def __init__(self, tables):
+        self._tables = tables
+    
+    def read(self):
+        return dict(self._tables)
+    
+    def write(self, data):
+        raise IOError("Database snapshots are read-only")
+
+
+class ShardedStorage(Storage):
+    
+    def __init__(self, path,
+                       shards=None,
+                       codec=None,
+                       pretty=False,
+                       workers=None):
+        
+        self._path = path
+        self._codec = get_codec(codec)
+        self._pretty = pretty
+        self._workers = workers
+        self._shard_data = {}
+        
+        os.makedirs(path, exist_ok=True)
+        self._lock = FileLock(self.get_lock_path())
+        meta_path = os.path.join(path, SHARDS_META)
+        
+        if os.path.isfile(meta_path):
+            
+            with open(meta_path, encoding="utf-8") as f:
+                self._shards = self._codec.loads(f.read())["shards"]
+            
+            if shards is not None and shards != self._shards:
+                raise ValueError(f"Database at {path} has {self._shards} "
+                                 "shards")
+        
+        else:
+            
+            self._shards = DEFAULT_SHARDS if shards is None else shards
+            
+            with open(meta_path, "w", encoding="utf-8") as f:
+                f.write(self._codec.dumps({"shards": self._shards}))
+    
+    def get_paths(self):
+        return [self._get_shard_path(shard) for shard in range(self._shards)]
+    
+    def get_lock_path(self):
+        return os.path.join(self._path, SHARDS_LOCK)
+    
+    # Full reads and writes are locked by LockingMiddleware
+    def read(self):
+        
+        self._shard_data = self._read_shards(range(self._shards))
+        result = {}
+        
+        for data in self._shard_data.values():
+            for table_name, docs in data.items():
+                result.setdefault(table_name, {}).update(docs)
+        
+        if not result: return None
+        return result
+    
+    def read_key_shard(self, table_name, key):
+        
+        shard = get_shard_index(key, self._shards)
+        
+        with self._lock.shared():
+            data = self._read_shards([shard]).get(shard, {})
+        
+        return data.get(table_name, {})
+    
+    def write(self, data):
+        
+        shard_data = {shard: {} for shard in range(self._shards)}
+        doc_shards = {}
+        
+        for table_name, docs in data.items():
+            
+            if table_name.startswith(VERSIONS_PREFIX): continue
+            
+            for doc_id, doc in docs.items():
+                shard = get_shard_index(get_doc_key(doc), self._shards)
+                shard_data[shard].setdefault(table_name, {})[doc_id] = doc
+                doc_shards[table_name, doc_id] = shard
+        
+        # Version numbers are stored in the same shard as their document
+        for table_name, versions in data.items():
+            
+            if not table_name.startswith(VERSIONS_PREFIX): continue
+            name = table_name[len(VERSIONS_PREFIX):]
+            
+            for doc_id, version in versions.items():
+                shard = doc_shards.get((name, doc_id), 0)
+                shard_data[shard].setdefault(table_name, {})[doc_id] = version
+        
+        # Only shards with new, replaced or removed documents are rewritten
+        for shard, tables in shard_data.items():
+            if _same_tables(tables, self._shard_data.get(shard, {})):
+                continue
+            self._write_shard(shard, tables)
+        
+        self._shard_data = shard_data
+    
+    def _read_shards(self, shards):
+        
+        paths = {shard: self._get_shard_path(shard) for shard in shards}
+        paths = {shard: path for shard, path in paths.items()
+                                                    if os.path.isfile(path)}
+        size = sum(os.path.getsize(path) for path in paths.values())
+        
+        if (len(paths) < 2 or
+            size < PARALLEL_READ_SIZE or
+            self._workers == 1):
+            loaded = [_load_json_file(path, self._codec.name)
+                                                for path in paths.values()]
+        else:
+            with ProcessPoolExecutor(self._workers) as executor:
+                loaded = list(executor.map(_load_json_file,
+                                           paths.values(),
+                                           repeat(self._codec.name)))
+        
+        return dict(zip(paths, loaded))
+    
+    def _write_shard(self, shard, tables):
+        
+        path = self._get_shard_path(shard)
+        
+        if not tables:
+            if os.path.isfile(path): os.remove(path)
+            return
+        
+        temp_path = f"{path}.tmp"
+        
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self._codec.dumps(tables, pretty=self._pretty))
+            f.flush()
+            os.fsync(f.fileno())
+        
+        os.replace(temp_path, path)
+    
+    def _get_shard_path(self, shard):
+        return os.path.join(self._path, f"shard-{shard:03d}.json")
+
+
+class LockingMiddleware(Middleware):
+    
+    def __init__(self, storage_cls):
+        super(LockingMiddleware, self).__init__(storage_cls)
+        self._paths = None
+        self._lock = None
+        self._signature = None
+        self._base = None
+        self._base_versions = {}
+        self._disk = {}
+        self._disk_versions = {}
+        self._merge_handler = None
+    
+    def __call__(self, path, *args, **kwargs):
+        
+        super(LockingMiddleware, self).__call__(path, *args, **kwargs)
+        
+        # Storages spread across several files give their own paths
+        if hasattr(self.storage, "get_paths"):
+            self._paths = tuple(self.storage.get_paths())
+            self._lock = FileLock(self.storage.get_lock_path())
+        else:
+            self._paths = (path, get_journal_path(path))
+            self._lock = FileLock(get_lock_path(path))
+        
+        return self
+    
+    def read(self):
+        
+        with self._lock.shared():
+            self._read_storage()
+        
+        self._base = _copy_tables(self._disk)
+        self._base_versions = _copy_tables(self._disk_versions)
+        
+        if not self._base: return None
+        return _copy_tables(self._base)
+    
+    def write(self, data):
+        
+        if self._base is None: self.read()
+        
+        with self._lock.exclusive():
+            
+            # Changes made by other processes since the last read or write
+            # are merged, unless they touch the same records
+            merged = self._get_signature() != self._signature
+            if merged: self._read_storage()
+            
+            disk = _copy_tables(self._disk)
+            versions = _copy_tables(self._disk_versions)
+            
+            for table_name in data.keys() | self._base.keys():
+                if self._merge_table(table_name, data, disk, versions):
+                    merged = True
+            
+            result = dict(disk)
+            
+            for table_name, table_versions in versions.items():
+                result[VERSIONS_PREFIX + table_name] = table_versions
+            
+            self.storage.write(result)
+            self._signature = self._get_signature()
+        
+        # The written data is the cache of the calling database, so it is
+        # updated with the merged records and any moved ids
+        if merged:
+            
+            for table_name in data.keys() - disk.keys():
+                del data[table_name]
+            
+            for table_name, docs in disk.items():
+                data[table_name] = dict(docs)
+            
+            if self._merge_handler is not None: self._merge_handler()
+        
+        self._disk = disk
+        self._disk_versions = versions
+        self._base = _copy_tables(data)
+        self._base_versions = {
+                table_name: {doc_id: versions[table_name][doc_id]
+                                for doc_id in docs
+                                    if doc_id in versions.get(table_name, {})}
+                        for table_name, docs in self._base.items()}
+    
+    def compact(self):
+        
+        with self._lock.exclusive():
+            if self._get_signature() != self._signature: self.storage.read()
+            self.storage.compact()
+            self._signature = self._get_signature()
+    
+    def get_version(self, table_name, doc_id):
+        return self._base_versions.get(table_name, {}).get(str(doc_id), 0)
+    
+    def set_merge_handler(self, handler):
+        self._merge_handler = handler
+    
+    def close(self):
+        self.storage.close()
+    
+    def _read_storage(self):
+        
+        data = self.storage.read()
+        if data is None: data = {}
+        
+        self._disk = {}
+        self._disk_versions = {}
+        
+        for table_name, docs in data.items():
+            if table_name.startswith(VERSIONS_PREFIX):
+                name = table_name[len(VERSIONS_PREFIX):]
+                self._disk_versions[name] = dict(docs)
+            else:
+                self._disk[table_name] = dict(docs)
+        
+        self._signature = self._get_signature()
+    
+    def _merge_table(self, table_name, data, disk, versions):
+        
+        docs = data.get(table_name, {})
+        base = self._base.get(table_name, {})
+        base_versions = self._base_versions.get(table_name, {})
+        disk_docs = disk.setdefault(table_name, {})
+        disk_versions = versions.setdefault(table_name, {})
+        
+        changed = [doc_id for doc_id, doc in docs.items()
+                                if doc_id not in base or
+                                   (base[doc_id] is not doc and
+                                    base[doc_id] != doc)]
+        removed = [doc_id for doc_id in base if doc_id not in docs]
+        
+        # Records inserted by both sides are all kept, moving this side's
+        # records to free ids where the other side used the same id
+        moved = {}
+        clashes = [doc_id for doc_id in changed
+                                if doc_id not in base and doc_id in disk_docs]
+        
+        if clashes:
+            next_id = max(int(doc_id) for doc_id in [*disk_docs, *docs]) + 1
+            for i, doc_id in enumerate(clashes):
+                moved[doc_id] = str(next_id + i)
+        
+        for doc_id in changed + removed:
+            
+            if doc_id not in base:
+                continue
+            elif doc_id in removed:
+                conflict = (doc_id in disk_docs and
+                            disk_versions.get(doc_id, 0) !=
+                                                base_versions.get(doc_id, 0))
+            else:
+                conflict = (doc_id not in disk_docs or
+                            disk_versions.get(doc_id, 0) !=
+                                                base_versions.get(doc_id, 0))
+            
+            if conflict:
+                raise ConflictError(f"Record {doc_id} in table "
+                                    f"'{table_name}' was changed by another "
+                                    "process")
+        
+        for doc_id in removed:
+            disk_docs.pop(doc_id, None)
+            disk_versions.pop(doc_id, None)
+        
+        for doc_id in changed:
+            new_id = moved.get(doc_id, doc_id)
+            disk_docs[new_id] = docs[doc_id]
+            disk_versions[new_id] = disk_versions.get(new_id, 0) + 1
+        
+        if table_name not in data and not disk_docs: del disk[table_name]
+        if not disk_versions: del versions[table_name]
+        
+        return bool(moved)
+    
+    def _get_signature(self):
+        
+        # The file contents are compared, rather than their sizes and
+        # modification times, which can miss a change of the same size
+        # within the resolution of the file system clock
+        signature = []
+        
+        for path in self._paths:
+            try:
+                with open(path, "rb") as f:
+                    signature.append(hashlib.sha1(f.read()).digest())
+            except OSError:
+                signature.append(None)
+        
+        return tuple(signature)
 
 
 class WriteSortMiddleware(Middleware):
     
     def __init__(self, storage_cls):
         super(WriteSortMiddleware, self).__init__(storage_cls)
+        self._ordered_docs = {}
+        self._ordered_ids = {}
+        self._reorder = False
+    
+    def read(self):
+        
+        data = self.storage.read()
+        if data is None: return None
+        
+        # Stored documents are already ordered, so they are only ordered
+        # again once they are replaced
+        for table_name, docs in data.items():
+            self._ordered_docs[table_name] = (dict(docs), dict(docs))
+        
+        return data
+    
+    def write(self, data):
+        data = self._order_tables(data)
+        self._reorder = False
+        self.storage.write(data)
+    
+    def clear_order(self):
+        # Documents read after this call are also ordered again, so the
+        # next write orders every document
+        self._ordered_docs = {}
+        self._ordered_ids = {}
+        self._reorder = True
+    
+    def close(self):
+        self.storage.close()
+    
+    def _order_tables(self, data):
+        
+        result = {}
+        
+        for table_name in natsorted(data.keys()):
+            
+            docs = data[table_name]
+            sources, ordered_docs = ({}, {}) if self._reorder else \
+                                self._ordered_docs.get(table_name, ({}, {}))
+            
+            # Documents are replaced rather than modified by the database,
+            # so only new or replaced documents need to be ordered again
+            dirty = [doc_id for doc_id, doc in docs.items()
+                                        if sources.get(doc_id) is not doc]
+            
+            if docs.keys() == ordered_docs.keys():
+                ordered_docs = dict(ordered_docs)
+                for doc_id in dirty:
+                    ordered_docs[doc_id] = _order_data(docs[doc_id])
+            else:
+                changed = {doc_id: _order_data(docs[doc_id])
+                                                        for doc_id in dirty}
+                ordered_docs = {doc_id: changed.get(doc_id,
+                                                    ordered_docs.get(doc_id))
+                        for doc_id in self._get_ordered_ids(table_name, docs)}
+            
+            self._ordered_docs[table_name] = (dict(docs), ordered_docs)
+            result[table_name] = ordered_docs
+        
+        return result
+    
+    def _get_ordered_ids(self, table_name, docs):
+        
+        if table_name not in self._ordered_ids:
+            ordered = natsorted(docs.keys())
+            sort_keys = [_natsort_key(doc_id) for doc_id in ordered]
+            self._ordered_ids[table_name] = (set(ordered), ordered, sort_keys)
+            return ordered
+        
+        doc_ids, ordered, sort_keys = self._ordered_ids[table_name]
+        if docs.keys() == doc_ids: return ordered
+        
+        for doc_id in doc_ids - docs.keys():
+            i = bisect.bisect_left(sort_keys, _natsort_key(doc_id))
+            del ordered[i]
+            del sort_keys[i]
+            doc_ids.discard(doc_id)
+        
+        for doc_id in docs.keys() - doc_ids:
+            key = _natsort_key(doc_id)
+            i = bisect.bisect_left(sort_keys, key)
+            ordered.insert(i, doc_id)
+            sort_keys.insert(i, key)
+            doc_ids.add(doc_id)
+        
+        return ordered
+
+
+class JournalMiddleware(Middleware):
+    
+    def __init__(self, storage_cls, journal=False):
+        super(JournalMiddleware, self).__init__(storage_cls)
+        self._journal = journal
+        self._journal_path = None
+        self._state = None
+    
+    def __call__(self, path, *args, **kwargs):
+        self._journal_path = get_journal_path(path)
+        return super(JournalMiddleware, self).__call__(path, *args, **kwargs)
+    
+    def read(self):
+        
+        data = self.storage.read()
+        if data is None: data = {}
+        
+        for entry in _read_journal(self._journal_path):
+            
+            docs = data.setdefault(entry["table"], {})
+            
+            if entry["op"] == "remove":
+                docs.pop(entry["id"], None)
+            else:
+                docs[entry["id"]] = entry["doc"]
+        
+        self._state = _copy_tables(data)
+        
+        if not data: return None
+        return data
+    
+    def write(self, data):
+        
+        if not self._journal:
+            self.storage.write(data)
+            self._remove_journal()
+            self._state = _copy_tables(data)
+            return
+        
+        if self._state is None: self.read()
+        
+        entries = _diff_tables(self._state, data)
+        
+        if entries:
+            with open(self._journal_path, "a") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + "\n")
+        
+        self._state = _copy_tables(data)
+    
+    def compact(self):
+        
+        if self._state is None: self.read()
+        
+        self.storage.write(self._state)
+        self._remove_journal()
+    
+    def close(self):
+        self.storage.close()
+    
+    def _remove_journal(self):
+        if os.path.isfile(self._journal_path): os.remove(self._journal_path)
+
+
+class SchemaReferenceMiddleware(Middleware):
+    
+    def __init__(self, storage_cls, schema=None, referenced=None):
+        
+        super(SchemaReferenceMiddleware, self).__init__(storage_cls)
+        
+        self._referenced = referenced
+        self._schema_hash = None
+        self._schemas = {}
+        self._schema_attrs = {}
+        self._docs = {}
+        
+        if schema is not None:
+            self._schema_hash = self._add_schema(schema.to_dict())
+    
+    def read(self):
+        
+        data = self.storage.read()
+        if data is None: data = {}
+        
+        data = dict(data)
+        schemas = data.pop(SCHEMAS_TABLE, {})
+        
+        if self._referenced is None: self._referenced = bool(schemas)
+        
+        for schema_hash, schema_dict in schemas.items():
+            self._schemas.setdefault(schema_hash, schema_dict)
+            if self._schema_hash is None: self._schema_hash = schema_hash
+        
+        result = {}
+        
+        for table_name, docs in data.items():
+            
+            if table_name.startswith(VERSIONS_PREFIX):
+                result[table_name] = docs
+                continue
+            
+            hydrated = {doc_id: self._hydrate(doc)
+                                            for doc_id, doc in docs.items()}
+            self._docs[table_name] = (dict(hydrated), dict(docs))
+            result[table_name] = hydrated
+        
+        if not result: return None
+        return result
+    
+    def write(self, data):
+        
+        if self._referenced and self._schema_hash is None:
+            raise ValueError("A schema is required to store records that "
+                             "reference a schema")
+        
+        result = {}
+        schema_hashes = set()
+        
+        for table_name, docs in data.items():
+            
+            if table_name.startswith(VERSIONS_PREFIX):
+                result[table_name] = docs
+                continue
+            
+            sources, stored = self._docs.get(table_name, ({}, {}))
+            new_stored = {}
+            
+            for doc_id, doc in docs.items():
+                
+                if (sources.get(doc_id) is doc and
+                    (SCHEMA_KEY in stored[doc_id]) == bool(self._referenced)):
+                    new_doc = stored[doc_id]
+                elif self._referenced:
+                    new_doc = self._dehydrate(doc)
+                else:
+                    new_doc = doc
+                
+                if SCHEMA_KEY in new_doc:
+                    schema_hashes.add(new_doc[SCHEMA_KEY])
+                
+                new_stored[doc_id] = new_doc
+            
+            self._docs[table_name] = (dict(docs), new_stored)
+            result[table_name] = new_stored
+        
+        if schema_hashes:
+            result[SCHEMAS_TABLE] = {schema_hash: self._schemas[schema_hash]
+                                        for schema_hash in schema_hashes}
+        
+        self.storage.write(result)
+    
+    def close(self):
+        self.storage.close()
+    
+    def _add_schema(self, schema_dict):
+        
+        schema_text = json.dumps(schema_dict, sort_keys=True)
+        schema_hash = hashlib.sha1(schema_text.encode()).hexdigest()[:16]
+        self._schemas.setdefault(schema_hash, schema_dict)
+        
+        return schema_hash
+    
+    def _get_schema_attrs(self, schema_hash):
+        
+        if schema_hash not in self._schema_attrs:
+            schema = SCHTree.from_dict(self._schemas[schema_hash])
+            self._schema_attrs[schema_hash] = {
+                        normalize_path(get_node_path(node)):
+                                    get_node_attr(node, blacklist=["name"])
+                                for node in PreOrderIter(schema.root_node)}
+        
+        return self._schema_attrs[schema_hash]
+    
+    def _hydrate(self, doc):
+        
+        if SCHEMA_KEY not in doc: return doc
+        
+        schema_attrs = self._get_schema_attrs(doc[SCHEMA_KEY])
+        result = {}
+        
+        for key, nodes in doc.items():
+            
+            if key == SCHEMA_KEY: continue
+            
+            hydrated = []
+            
+            for node in nodes:
+                
+                path = get_doc_node_path(node)
+                new_node = {k: v for k, v in node.items()
+                                                    if k != MISSING_KEY}
+                
+                for attr, value in schema_attrs.get(path, {}).items():
+                    if attr in new_node: continue
+                    if attr in node.get(MISSING_KEY, []): continue
+                    new_node[attr] = value
+                
+                hydrated.append(new_node)
+            
+            result[key] = hydrated
+        
+        return result
+    
+    def _dehydrate(self, doc):
+        
+        schema_attrs = self._get_schema_attrs(self._schema_hash)
+        result = {SCHEMA_KEY: self._schema_hash}
+        
+        for key, nodes in doc.items():
+            
+            dehydrated = []
+            
+            for node in nodes:
+                
+                path = get_doc_node_path(node)
+                
+                if path not in schema_attrs:
+                    dehydrated.append(dict(node))
+                    continue
+                
+                attrs = schema_attrs[path]
+                new_node = {k: v for k, v in node.items()
+                                    if k not in attrs or attrs[k] != v}
+                missing = [attr for attr in attrs if attr not in node]
+                if missing: new_node[MISSING_KEY] = missing
+                
+                dehydrated.append(new_node)
+            
+            result[key] = dehydrated
+        
+        return result
+
+
+class DataBase(metaclass=abc.ABCMeta):
+    
+    def __init__(self, *args, **kwargs):
+        self._db = self._get_db(*args, **kwargs)
+        self._indexes = {}
+        self._query_cache = QueryCache()
+    
+    def __enter__(self):
+        self._db.__enter__()
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._db.__exit__(exc_type, exc_val, exc_tb)
+    
+    @abc.abstractmethod
+    def _get_db(self, *args, **kwargs):
+        pass
+    
+    @abc.abstractmethod
+    def _get_repr(self):
+        pass
+    
+    def close(self):
+        self._db.close()
+    
+    def insert(self, record):
+        doc = record.to_dict()
+        self._check_key(doc)
+        doc_id = self._db.insert(doc)
+        self._update_indexes(doc_id, doc)
+        return doc_id
+    
+    def remove(self, doc_ids):
+        
+        doc_ids = self._db.remove(doc_ids=doc_ids)
+        
+        for doc_id in doc_ids:
+            self._update_indexes(doc_id)
+    
+    def replace(self, doc_id, record):
+        doc = record.to_dict()
+        self._check_key(doc, doc_id)
+        self.remove([doc_id])
+        self._db.insert(table.Document(doc, doc_id=doc_id))
+        self._update_indexes(doc_id, doc)
+    
+    def upsert_many(self, records, key="root value", remove_missing=False):
+        
+        if key != "root value":
+            raise ValueError(f"Unsupported upsert key '{key}'")
+        
+        docs = {}
+        
+        # Records are matched by their key, and later records with the
+        # same key take precedence
+        for record in records:
+            
+            doc = record.to_dict()
+            doc_key = get_doc_key(doc)
+            
+            if doc_key is None:
+                raise ValueError("Records without a root value can not be "
+                                 "upserted")
+            
+            docs[doc_key] = doc
+        
+        doc_ids = self._get_key_ids(list(docs))
+        inserted = [doc for doc_key, doc in docs.items()
+                                                if doc_ids[doc_key] is None]
+        replaced = {doc_ids[doc_key]: doc for doc_key, doc in docs.items()
+                                            if doc_ids[doc_key] is not None}
+        
+        replaced_ids = sorted(replaced)
+        unchanged = []
+        
+        # Stored documents are read in chunks, like the other read paths
+        for i in range(0, len(replaced_ids), READ_CHUNK_SIZE):
+            chunk = replaced_ids[i:i + READ_CHUNK_SIZE]
+            unchanged.extend(doc_id for doc_id, doc in self._read_chunk(chunk)
+                                            if doc == replaced[doc_id])
+        
+        for doc_id in unchanged:
+            del replaced[doc_id]
+        
+        if remove_missing:
+            removed = sorted(self._all_ids() - set(replaced) - set(unchanged))
+        else:
+            removed = []
+        
+        doc_ids = self._write_changes(inserted, replaced, removed)
+        
+        return {"inserted": doc_ids,
+                "replaced": sorted(replaced),
+                "unchanged": unchanged,
+                "removed": removed}
+    
+    def snapshot(self):
+        return SnapshotDataBase(self._get_tables())
+    
+    def get_by_key(self, key):
+        return self._get_key_ids([key])[key]
+    
+    def has_key(self, key):
+        return key in self._get_index(KeyIndex)
+    
+    def keys(self):
+        return list(self._get_index(KeyIndex).keys())
+    
+    def flush(self):
+        null = lambda x: x
+        self._db._update_table(null)
+    
+    def count(self, query):
+        
+        if isinstance(query, IndexedQuery):
+            return len(self._search_ids(query))
+        
+        return len(self.search_ids(query))
+    
+    def search(self, query):
+        return SearchResult(self, self.search_ids(query))
+    
+    def search_ids(self, query):
+        
+        if isinstance(query, IndexedQuery):
+            return sorted(self._search_ids(query))
+        
+        # TinyDB searches test plain dictionaries, but queries may also
+        # test the document ids
+        return sorted(doc.doc_id for doc in self._db if query(doc))
+    
+    def bitmap(self, query=None):
+        
+        if query is None: return self._all_bits()
+        if isinstance(query, IndexedQuery): return query.bits(self)
+        
+        return to_bitmap(self.search_ids(query))
+    
+    def select(self, where):
+        if isinstance(where, str): where = parse_query(where)
+        return self.search(where)
+    
+    def to_records(self, workers=None):
+        
+        if is_parallel(len(self), workers):
+            return self.map_records(_return_record, workers=workers)
+        
+        return OrderedDict((doc_id, SCHTree.from_dict(doc, compact=True))
+                                   for doc_id, doc in self._sorted_documents())
+    
+    def to_views(self):
+        return OrderedDict((doc_id, RecordView(doc))
+                                   for doc_id, doc in self._sorted_documents())
+    
+    def iter_records(self, query=None,
+                           paths=None,
+                           chunk_size=READ_CHUNK_SIZE,
+                           view=False):
+        
+        if paths is not None and not _is_iterable(paths):
+            paths = (paths,)
+        
+        doc_ids = self._sorted_ids(query)
+        
+        for i in range(0, len(doc_ids), chunk_size):
+            
+            for doc_id, doc in self._read_chunk(doc_ids[i:i + chunk_size]):
+                
+                if paths is not None: doc = _prune_doc(doc, paths)
+                
+                if view:
+                    yield doc_id, RecordView(doc)
+                else:
+                    yield doc_id, SCHTree.from_dict(doc, compact=True)
+    
+    def map_records(self, func,
+                          query=None,
+                          workers=None,
+                          view=False,
+                          chunk_size=PARALLEL_CHUNK_SIZE):
+        
+        doc_ids = self._sorted_ids(query)
+        chunks = ([(doc_id, dict(doc)) for doc_id, doc in
+                                self._read_chunk(doc_ids[i:i + chunk_size])]
+                                    for i in range(0, len(doc_ids), chunk_size))
+        mapper = partial(_map_docs, func, view)
+        
+        # Records are built and processed in the workers, so only the
+        # documents and the results are passed between processes. For
+        # to_records, the results are the pickled records themselves
+        if is_parallel(len(doc_ids), workers):
+            with ProcessPoolExecutor(workers) as executor:
+                results = list(executor.map(mapper, chunks))
+        else:
+            results = map(mapper, chunks)
+        
+        return OrderedDict(item for result in results for item in result)
+    
+    def projection(self, paths=None, query=None):
+        
+        if not _is_iterable(paths):
+            paths = (paths,)
+        
+        result = {"id": []}
+        values = [[] for _ in paths]
+        
+        for doc_id, record in self.iter_records(query,
+                                                paths=paths,
+                                                view=True):
+            
+            result["id"].append(doc_id)
+            
+            for path, path_values in zip(paths, values):
+                path_values.append(get_record_props(record, path))
+        
+        for path, path_values in zip(paths, values):
+            
+            if path is None:
+                path = self._get_root_name(result["id"])
+            
+            result[path] = path_values
+        
+        return result
+    
+    def _iter_documents(self):
+        for doc in self._db:
+            yield doc.doc_id, dict(doc)
+    
+    def _sorted_documents(self):
+        
+        docs = {doc.doc_id: doc for doc in self._db}
+        
+        for doc_id in self._get_index(SortIndex):
+            yield doc_id, docs[doc_id]
+    
+    def _sorted_ids(self, query=None):
+        
+        doc_ids = self._get_index(SortIndex)
+        if query is None: return list(doc_ids)
+        
+        if isinstance(query, IndexedQuery):
+            matches = self._search_ids(query)
+        else:
+            matches = set(self.search_ids(query))
+        
+        return [doc_id for doc_id in doc_ids if doc_id in matches]
+    
+    def _read_chunk(self, doc_ids):
+        for doc_id in doc_ids:
+            yield doc_id, self._db.get(doc_id=doc_id)
+    
+    def _get_root_name(self, doc_ids):
+        
+        if not doc_ids: return None
+        
+        _, doc = next(self._read_chunk(doc_ids[:1]))
+        
+        return doc["L0"][0]["name"]
+    
+    def _insert_documents(self, documents):
+        
+        docs = [table.Document(doc, doc_id=doc_id)
+                                            for doc_id, doc in documents]
+        self._db.insert_multiple(docs)
+        
+        for doc in docs:
+            self._update_indexes(doc.doc_id, doc)
+    
+    def _check_key(self, doc, doc_id=None):
+        
+        key = get_doc_key(doc)
+        if key is None: return
+        
+        owner = self.get_by_key(key)
+        if owner is None or owner == doc_id: return
+        
+        # Records that already share a key can still be replaced
+        if doc_id is not None:
+            if doc_id in self._get_index(KeyIndex).get_ids(key): return
+        
+        raise ValueError(f"A record with key '{key}' already exists")
+    
+    def _get_tables(self):
+        
+        # Table updates replace the stored table rather than modifying it,
+        # so the current documents can be shared without copying
+        tables = self._db.storage.read() or {}
+        name = self._db.default_table_name
+        
+        return {name: tables.get(name, {})}
+    
+    def _write_changes(self, inserted, replaced, removed):
+        
+        doc_ids = [self._db._get_next_id() for _ in inserted]
+        
+        # Apply every change in a single read-modify-write of the table
+        def updater(docs):
+            for doc_id in removed: docs.pop(doc_id, None)
+            docs.update(replaced)
+            docs.update(zip(doc_ids, inserted))
+        
+        self._db._update_table(updater)
+        
+        for doc_id in removed:
+            self._update_indexes(doc_id)
+        
+        for doc_id, doc in [*replaced.items(), *zip(doc_ids, inserted)]:
+            self._update_indexes(doc_id, doc)
+        
+        return doc_ids
+    
+    def _get_key_ids(self, keys):
+        index = self._get_index(KeyIndex)
+        return {key: index.get(key) for key in keys}
+    
+    def _clear_caches(self):
+        
+        # Called once records written by other processes are merged in, as
+        # the document ids and the next free id may have changed
+        self._indexes = {}
+        self._query_cache.clear()
+        self._db.clear_cache()
+        self._db.table(self._db.default_table_name)._next_id = None
+    
+    def _get_index(self, index_cls):
+        
+        if index_cls not in self._indexes:
+            self._indexes[index_cls] = index_cls(self._iter_documents())
+        
+        return self._indexes[index_cls]
+    
+    def _update_indexes(self, doc_id, doc=None):
+        
+        for index in [*self._indexes.values(), self._query_cache]:
+            if doc is None:
+                index.discard(doc_id)
+            else:
+                index.add(doc_id, doc)
+    
+    def _search_ids(self, query):
+        
+        doc_ids = self._query_cache.get(query)
+        
+        if doc_ids is None:
+            doc_ids = frozenset(query.ids(self))
+            self._query_cache.put(query, doc_ids)
+        
+        return doc_ids
+    
+    def _all_ids(self):
+        return frozenset(self._get_index(SortIndex))
+    
+    def _all_bits(self):
+        return to_bitmap(self._all_ids())
+    
+    def _path_bits(self, path):
+        
+        index = self._get_index(BitmapIndex)
+        if path in index: return index.get(path)
+        
+        return to_bitmap(self._path_ids(path))
+    
+    def _ids_bits(self, query):
+        return to_bitmap(self._search_ids(query))
+    
+    def _path_ids(self, path):
+        return self._get_index(PathIndex).get(path)
+    
+    def _value_ids(self, path, value, exact=False):
+        return self._get_index(ValueIndex).get(path, value, exact)
+    
+    def _compare_ids(self, path, op, value):
+        index = self._get_index(ValueIndex)
+        
+        return frozenset(doc_id for stored, doc_ids in index.items(path)
+                                    if compare_values(stored, op, value)
+                                        for doc_id in doc_ids)
+    
+    def __len__(self):
+        return len(self._db)
+    
+    def __repr__(self):
+        return f"<{self._get_repr()}>"
+
+
+class JSONDataBase(DataBase):
+    
+    def _get_db(self, db_path="db.json",
+                      check_existing=False,
+                      access_mode='r+',
+                      journal=False,
+                      schema=None,
+                      referenced=None,
+                      codec=None,
+                      pretty=False):
+        
+        if check_existing and not os.path.isfile(db_path):
+            raise IOError(f"Path {db_path} does not contain a valid database")
+        
+        self._path = db_path
+        
+        db = TinyDB(db_path,
+                    codec=codec,
+                    pretty=pretty,
+                    access_mode=access_mode,
+                    storage=CachingMiddleware(
+                                LockingMiddleware(
+                                    SchemaReferenceMiddleware(
+                                        JournalMiddleware(
+                                            WriteSortMiddleware(CodecStorage),
+                                            journal=journal),
+                                        schema=schema,
+                                        referenced=referenced))))
+        db.storage.set_merge_handler(self._clear_caches)
+        
+        return db
+    
+    def _get_repr(self):
+        return f"JSONDataBase records: {len(self)} path: {self._path}"
+    
+    def flush(self):
+        # An explicit flush also orders documents stored out of order
+        self._db.storage.clear_order()
+        super().flush()
+    
+    def get_version(self, doc_id):
+        storage = self._db.storage
+        storage.read()
+        return storage.get_version(self._db.default_table_name, doc_id)
+    
+    def compact(self):
+        storage = self._db.storage
+        storage.flush()
+        storage.compact()
+
+
+class ShardedJSONDataBase(DataBase):
+    
+    def _get_db(self, db_path="db",
+                      check_existing=False,
+                      shards=None,
+                      codec=None,
+                      pretty=False,
+                      workers=None):
+        
+        if (check_existing and
+            not os.path.isfile(os.path.join(db_path, SHARDS_META))):
+            raise IOError(f"Path {db_path} does not contain a valid database")
+        
+        self._path = db_path
+        
+        db = TinyDB(db_path,
+                    shards=shards,
+                    codec=codec,
+                    pretty=pretty,
+                    workers=workers,
+                    storage=CachingMiddleware(
+                                LockingMiddleware(
+                                    WriteSortMiddleware(ShardedStorage))))
+        db.storage.set_merge_handler(self._clear_caches)
+        
+        return db
+    
+    def _get_repr(self):
+        return f"ShardedJSONDataBase records: {len(self)} path: {self._path}"
+    
+    def get_by_key(self, key):
+        
+        if KeyIndex in self._indexes or self._db.storage.cache is not None:
+            return super().get_by_key(key)
+        
+        # Until the records are loaded, only the shard for the key is read
+        docs = self._db.storage.read_key_shard(self._db.default_table_name,
+                                               key)
+        
+        for doc_id, doc in docs.items():
+            if get_doc_key(doc) == key: return int(doc_id)
+        
+        return None
+    
+    def has_key(self, key):
+        return self.get_by_key(key) is not None
+    
+    def get_version(self, doc_id):
+        storage = self._db.storage
+        storage.read()
+        return storage.get_version(self._db.default_table_name, doc_id)
+    
+    def flush(self):
+        self._db.storage.clear_order()
+        super().flush()
+    
+    def compact(self):
+        self.flush()
+
+
+class MemoryDataBase(DataBase):
+    
+    def _get_db(self, documents=None):
+        
+        memdb = TinyDB(storage=MemoryStorage)
+        
+        if documents is not None:
+            memdb.insert_multiple(documents)
+        
+        return memdb
     
-    def read(self):
-        data = self.storage.read()
-        return data
+    def _get_repr(self):
+        return f"MemoryDataBase records: {len(self)}"
+
+
+class SnapshotDataBase(DataBase):
     
-    def write(self, data):
-        data = _order_data(data)
-        self.storage.write(data)
+    def _get_db(self, tables):
+        return TinyDB(tables, storage=SnapshotStorage)
     
-    def close(self):
-        self.storage.close()
+    def _get_repr(self):
+        return f"SnapshotDataBase records: {len(self)}"
 
 
-class DataBase(metaclass=abc.ABCMeta):
+class SQLiteDataBase(DataBase):
     
-    def __init__(self, *args, **kwargs):
-        self._db = self._get_db(*args, **kwargs)
+    def _get_db(self, db_path="db.sqlite", check_existing=False):
+        
+        if check_existing and not os.path.isfile(db_path):
+            raise IOError(f"Path {db_path} does not contain a valid database")
+        
+        self._path = db_path
+        
+        connection = sqlite3.connect(db_path)
+        connection.create_function("py_lower", 1, _lower)
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_id INTEGER PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS nodes (
+                doc_id INTEGER NOT NULL,
+                level INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                parent TEXT,
+                name TEXT NOT NULL,
+                path TEXT NOT NULL,
+                value TEXT,
+                attrs TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS nodes_doc ON nodes (doc_id);
+            CREATE INDEX IF NOT EXISTS nodes_path ON nodes (path, doc_id);
+            CREATE INDEX IF NOT EXISTS nodes_value ON nodes (path, value);
+            CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent);
+            CREATE INDEX IF NOT EXISTS nodes_root ON nodes (level, value);
+            """)
+        
+        return connection
+    
+    def _get_repr(self):
+        return f"SQLiteDataBase records: {len(self)} path: {self._path}"
     
     def __enter__(self):
-        self._db.__enter__()
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._db.__exit__(exc_type, exc_val, exc_tb)
-    
-    @abc.abstractmethod
-    def _get_db(self, *args, **kwargs):
-        pass
-    
-    @abc.abstractmethod
-    def _get_repr(self):
-        pass
+        
+        if exc_type is None:
+            self._db.commit()
+        else:
+            self._db.rollback()
+        
+        self._db.close()
     
     def close(self):
+        self._db.commit()
         self._db.close()
     
     def insert(self, record):
-        self._db.insert(record.to_dict())
+        doc = record.to_dict()
+        self._check_key(doc)
+        return self._insert_doc(None, doc)
     
     def remove(self, doc_ids):
-        self._db.remove(doc_ids=doc_ids)
+        
+        doc_ids = [(doc_id,) for doc_id in doc_ids]
+        
+        self._db.executemany("DELETE FROM nodes WHERE doc_id = ?", doc_ids)
+        self._db.executemany("DELETE FROM documents WHERE doc_id = ?",
+                             doc_ids)
+        
+        for doc_id, in doc_ids:
+            self._update_indexes(doc_id)
     
     def replace(self, doc_id, record):
+        doc = record.to_dict()
+        self._check_key(doc, doc_id)
         self.remove([doc_id])
-        self._db.insert(table.Document(record.to_dict(), doc_id=doc_id))
+        self._insert_doc(doc_id, doc)
     
     def flush(self):
-        null = lambda x: x
-        self._db._update_table(null)
+        self._db.commit()
+    
+    def compact(self):
+        self._db.commit()
+        self._db.execute("VACUUM")
     
     def count(self, query):
-        return self._db.count(query)
+        
+        if isinstance(query, IndexedQuery):
+            return len(self._search_ids(query))
+        
+        return len(self.search_ids(query))
     
-    def search(self, query):
-        documents = self._db.search(query)
-        if not documents: documents = None
-        return MemoryDataBase(documents)
+    def search_ids(self, query):
+        
+        if isinstance(query, IndexedQuery):
+            return sorted(self._search_ids(query))
+        
+        return sorted(doc_id for doc_id, doc in self._iter_documents()
+                            if query(table.Document(doc, doc_id=doc_id)))
     
-    def to_records(self):
-        sorter = _get_doc_sorter()
-        return OrderedDict((doc.doc_id, SCHTree.from_dict(dict(doc)))
-                                   for doc in sorted(self._db, key=sorter))
+    def to_records(self, workers=None):
+        
+        if is_parallel(len(self), workers):
+            return self.map_records(_return_record, workers=workers)
+        
+        docs = dict(self._read_documents())
+        
+        return OrderedDict((doc_id, SCHTree.from_dict(docs[doc_id],
+                                                      compact=True))
+                                            for doc_id in self._sorted_ids())
     
-    def projection(self, paths=None):
+    def to_views(self):
         
-        def _get_node_props(node):
-            
-            result = get_node_attr(node)
-            
-            if not node.children: return result
-            
-            sorter = _get_node_sorter()
-            child_names = [child.name for child in sorted(node.children,
-                                                          key=sorter)]
-            result["children"] = child_names
-            
-            return result
+        docs = dict(self._read_documents())
+        
+        return OrderedDict((doc_id, RecordView(docs[doc_id]))
+                                            for doc_id in self._sorted_ids())
+    
+    def has_key(self, key):
+        return self.get_by_key(key) is not None
+    
+    def projection(self, paths=None, query=None):
         
         if not _is_iterable(paths):
             paths = (paths,)
         
-        records = self.to_records()
-        result = {"id": [rid for rid in records.keys()]}
+        doc_ids = self._sorted_ids(query)
+        result = {"id": doc_ids}
         
         for path in paths:
             
-            values = []
+            if path is None:
+                where = "level = 0"
+                params = ()
+            else:
+                where = "path = ?"
+                params = (normalize_path(path),)
             
-            for record in records.values():
-                
-                node = None
+            cursor = self._db.execute(
+                        "SELECT doc_id, name, path, value, attrs "
+                        f"FROM nodes WHERE {where}", params)
+            props = {}
+            
+            for doc_id, name, node_path, value, attrs in cursor:
+                props[doc_id] = _get_row_props(name, value, attrs)
+                if path is None: path = name
+            
+            cursor = self._db.execute(
+                        "SELECT c.doc_id, c.name, c.value "
+                        "FROM nodes AS c JOIN nodes AS p "
+                        "ON c.doc_id = p.doc_id AND c.parent = p.path "
+                        f"WHERE p.{where}", params)
+            children = {}
+            
+            for doc_id, name, value in cursor:
+                children.setdefault(doc_id, []).append((name, value))
+            
+            for doc_id, child_nodes in children.items():
+                child_nodes.sort(key=lambda x: (_lower(x[0]), _lower(x[1])))
+                props[doc_id]["children"] = [name for name, _ in child_nodes]
+            
+            result[path] = [props.get(doc_id, {}) for doc_id in doc_ids]
+        
+        return result
+    
+    def _iter_documents(self):
+        return self._read_documents()
+    
+    def _get_tables(self):
+        return {"_default": {str(doc_id): doc
+                                for doc_id, doc in self._read_documents()}}
+    
+    def _get_index(self, index_cls):
+        
+        # The key index only needs the root nodes
+        if index_cls is KeyIndex and index_cls not in self._indexes:
+            self._indexes[index_cls] = KeyIndex(self._read_roots())
+        
+        return super()._get_index(index_cls)
+    
+    def _insert_documents(self, documents):
+        for doc_id, doc in documents:
+            self._insert_doc(doc_id, doc)
+    
+    def _write_changes(self, inserted, replaced, removed):
+        
+        self.remove([*removed, *replaced])
+        
+        for doc_id, doc in replaced.items():
+            self._insert_doc(doc_id, doc)
+        
+        return [self._insert_doc(None, doc) for doc in inserted]
+    
+    def _insert_doc(self, doc_id, doc):
+        
+        cursor = self._db.execute(
+                        "INSERT INTO documents (doc_id) VALUES (?)", (doc_id,))
+        doc_id = cursor.lastrowid
+        rows = []
+        level = 0
+        
+        while f"L{level}" in doc:
+            
+            for position, node in enumerate(doc[f"L{level}"]):
                 
-                if path is None:
-                    node = record.root_node
-                    path = node.name
-                else:
-                    try:
-                        node = record.find_by_path(path)
-                    except ChildResolverError:
-                        pass
+                attrs = {k: v for k, v in node.items()
+                                        if k not in ("name", "parent")}
+                value = attrs.get("value")
                 
-                if node is None:
-                    value = {}
+                if isinstance(value, str):
+                    del attrs["value"]
                 else:
-                    value = _get_node_props(node)
+                    value = None
                 
-                values.append(value)
+                rows.append((doc_id,
+                             level,
+                             position,
+                             node.get("parent"),
+                             node["name"],
+                             get_doc_node_path(node),
+                             value,
+                             json.dumps(attrs)))
+            
+            level += 1
+        
+        self._db.executemany(
+                        "INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        rows)
+        self._update_indexes(doc_id, doc)
+        
+        return doc_id
+    
+    def _read_documents(self, sql=None, params=()):
+        
+        query = ("SELECT doc_id, level, parent, name, value, attrs "
+                 "FROM nodes ")
+        if sql is not None: query += f"WHERE doc_id IN ({sql}) "
+        query += "ORDER BY doc_id, level, position"
+        
+        doc_id = None
+        doc = None
+        
+        for row in self._db.execute(query, params):
+            
+            if row[0] != doc_id:
+                if doc is not None: yield doc_id, doc
+                doc_id = row[0]
+                doc = {}
+            
+            _, level, parent, name, value, attrs = row
+            
+            node = {"name": name}
+            if parent is not None: node["parent"] = parent
+            node.update(json.loads(attrs))
+            if value is not None: node["value"] = value
+            
+            doc.setdefault(f"L{level}", []).append(node)
+        
+        if doc is not None: yield doc_id, doc
+    
+    def _get_key_ids(self, keys):
+        
+        if KeyIndex in self._indexes or not all(isinstance(key, str)
+                                                        for key in keys):
+            return super()._get_key_ids(keys)
+        
+        # Until the key index is needed, keys are looked up in the stored
+        # root values, which have their own index in the file
+        result = dict.fromkeys(keys)
+        
+        for i in range(0, len(keys), READ_CHUNK_SIZE):
+            
+            chunk = keys[i:i + READ_CHUNK_SIZE]
+            sql = ", ".join("?" * len(chunk))
+            cursor = self._db.execute(
+                        "SELECT value, MIN(doc_id) FROM nodes "
+                        f"WHERE level = 0 AND value IN ({sql}) "
+                        "GROUP BY value", chunk)
             
-            result[path] = values
+            result.update(cursor)
         
         return result
     
-    def __len__(self):
-        return len(self._db)
+    def _read_roots(self):
+        
+        cursor = self._db.execute(
+                    "SELECT doc_id, name, value, attrs FROM nodes "
+                    "WHERE level = 0")
+        
+        for doc_id, name, value, attrs in cursor:
+            if value is None: value = json.loads(attrs).get("value")
+            yield doc_id, {"L0": [{"name": name, "value": value}]}
     
-    def __repr__(self):
-        return f"<{self._get_repr()}>"
+    def _sorted_ids(self, query=None):
+        
+        cursor = self._db.execute(
+                    "SELECT d.doc_id FROM documents AS d "
+                    "LEFT JOIN nodes AS n ON d.doc_id = n.doc_id "
+                    "AND n.level = 0 "
+                    "ORDER BY py_lower(n.name), py_lower(n.value), d.doc_id")
+        doc_ids = [row[0] for row in cursor]
+        
+        if query is None: return doc_ids
+        
+        if isinstance(query, IndexedQuery):
+            matches = self._search_ids(query)
+        else:
+            matches = set(self.search_ids(query))
+        
+        return [doc_id for doc_id in doc_ids if doc_id in matches]
+    
+    def _all_ids(self):
+        cursor = self._db.execute("SELECT doc_id FROM documents")
+        return frozenset(row[0] for row in cursor)
+    
+    def _path_ids(self, path):
+        return self._get_node_ids(NodeQuery(path))
+    
+    def _value_ids(self, path, value, exact=False):
+        return self._get_node_ids(NodeQuery(path, value, exact))
+    
+    def _compare_ids(self, path, op, value):
+        
+        cursor = self._db.execute(
+                    "SELECT doc_id, value, attrs FROM nodes WHERE path = ?",
+                    (normalize_path(path),))
+        result = set()
+        
+        for doc_id, stored, attrs in cursor:
+            
+            if stored is None: stored = json.loads(attrs).get("value")
+            if stored is None: continue
+            
+            if compare_values(stored, op, value): result.add(doc_id)
+        
+        return frozenset(result)
+    
+    def _get_node_ids(self, query):
+        sql, params = _get_query_sql(query)
+        return frozenset(row[0] for row in self._db.execute(sql, params))
+    
+    def _read_chunk(self, doc_ids):
+        
+        sql = ", ".join("?" * len(doc_ids))
+        docs = dict(self._read_documents(sql, doc_ids))
+        
+        for doc_id in doc_ids:
+            yield doc_id, docs[doc_id]
+    
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
 
 
-class JSONDataBase(DataBase):
+class SearchResult:
     
-    def _get_db(self, db_path="db.json",
-                      check_existing=False,
-                      access_mode='r+'):
-        
-        if check_existing and not os.path.isfile(db_path):
-            raise IOError(f"Path {db_path} does not contain a valid database")
+    def __init__(self, db, doc_ids):
+        self._parent = db
+        self._query = IdQuery(doc_ids)
+    
+    def count(self, query=None):
+        return len(self.search_ids(query))
+    
+    def search(self, query):
+        return SearchResult(self._parent, self.search_ids(query))
+    
+    def search_ids(self, query=None):
         
-        self._path = db_path
+        doc_ids = self._query.doc_ids
+        if query is None: return sorted(doc_ids)
         
-        return TinyDB(db_path,
-                      indent=4,
-                      separators=(',', ': '),
-                      access_mode=access_mode,
-                      storage=CachingMiddleware(
-                                            WriteSortMiddleware(JSONStorage)))
+        return [doc_id for doc_id in self._parent.search_ids(query)
+                                                        if doc_id in doc_ids]
     
-    def _get_repr(self):
-        return f"JSONDataBase records: {len(self)} path: {self._path}"
+    def select(self, where):
+        if isinstance(where, str): where = parse_query(where)
+        return self.search(where)
+    
+    def to_records(self, workers=None):
+        return self._parent.map_records(_return_record,
+                                        self._query,
+                                        workers)
+    
+    def to_views(self):
+        return OrderedDict(self.iter_records(view=True))
+    
+    def iter_records(self, query=None,
+                           paths=None,
+                           chunk_size=READ_CHUNK_SIZE,
+                           view=False):
+        return self._parent.iter_records(self._get_query(query),
+                                         paths,
+                                         chunk_size,
+                                         view)
+    
+    def projection(self, paths=None):
+        return self._parent.projection(paths, self._query)
+    
+    def _get_query(self, query):
+        if query is None: return self._query
+        return IdQuery(self.search_ids(query))
+    
+    def __iter__(self):
+        return iter(self._parent._sorted_ids(self._query))
+    
+    def __contains__(self, doc_id):
+        return doc_id in self._query.doc_ids
+    
+    def __len__(self):
+        return len(self._query.doc_ids)
+    
+    def __repr__(self):
+        return f"<SearchResult records: {len(self)}>"
 
 
-class MemoryDataBase(DataBase):
+def open_database(db_path, **kwargs):
     
-    def _get_db(self, documents=None):
+    if os.path.splitext(db_path)[1].lower() in SQLITE_EXTENSIONS:
         
-        memdb = TinyDB(storage=MemoryStorage)
+        for key in ("journal", "schema", "referenced", "codec", "pretty"):
+            kwargs.pop(key, None)
         
-        if documents is not None:
-            memdb.insert_multiple(documents)
+        return SQLiteDataBase(db_path, **kwargs)
+    
+    if os.path.isdir(db_path) or db_path.endswith(("/", os.sep)):
         
-        return memdb
+        for key in ("journal", "schema", "referenced"):
+            kwargs.pop(key, None)
+        
+        return ShardedJSONDataBase(db_path, **kwargs)
     
-    def _get_repr(self):
-        return f"MemoryDataBase records: {len(self)}"
+    return JSONDataBase(db_path, **kwargs)
 
 
-def make_query(path, value=None, exact=False):
+def convert_database(src_path, dst_path):
     
-    query = Query()
-    path_resolution = path.strip('/').split('/')
+    with open_database(src_path, check_existing=True) as src:
+        with open_database(dst_path) as dst:
+            
+            if len(dst) > 0:
+                raise ValueError(f"Database at {dst_path} is not empty")
+            
+            dst._insert_documents(src._iter_documents())
+
+
+def make_query(path=None, value=None, exact=False, where=None):
     
-    if len(path_resolution) == 1:
-        result = query['L0'].any(query.name == path_resolution[0])
-    else:
-        result = query[f'L{len(path_resolution) - 1}'].any(
-                            (query.name == path_resolution[-1]) &
-                            (query.parent == '/'.join(path_resolution[:-1])))
+    queries = []
     
-    if value is not None:
-        
-        if exact:
-            test = lambda value, search: search == value
-        else:
-            test = lambda value, search: search in value
-            
-        result &= query[f'L{len(path_resolution) - 1}'].any(
-            (query.name == path_resolution[-1]) &
-            (query.value.test(test, value)))
+    if path is not None: queries.append(NodeQuery(path, value, exact))
+    if where is not None: queries.append(parse_query(where))
     
-    return result
+    if not queries: raise ValueError("A path or query is required")
+    if len(queries) == 1: return queries[0]
+    
+    return AndQuery(*queries)
+
+
+def get_journal_path(db_path):
+    return f"{db_path}.journal"
+
+
+def get_lock_path(db_path):
+    return f"{db_path}.lock"
+
+
+def get_shard_index(key, shards):
+    
+    if key is None: return 0
+    
+    digest = hashlib.sha1(str(key).encode("utf-8")).digest()
+    
+    return int.from_bytes(digest[:4], "big") % shards
+
+
+def is_parallel(n_records, workers=None):
+    # Process pools are only used when more than one worker is requested
+    if workers is None: return False
+    return workers > 1 and n_records >= PARALLEL_MIN_RECORDS
 
 
 def filter_unique_children(db, path):
@@ -214,12 +1796,39 @@ def filter_unique_children(db, path):
         return False
     
     unique_docs = [table.Document(value.to_dict(), doc_id=key)
-                       for key, value in db.to_records().items()
+                       for key, value in db.to_views().items()
                            if check_unique(value, path)]
     
     return MemoryDataBase(unique_docs)
 
 
+def get_record_props(record, path=None):
+    
+    if path is None:
+        node = record.root_node
+    else:
+        try:
+            node = record.find_by_path(path)
+        except ChildResolverError:
+            return {}
+    
+    return get_node_props(node)
+
+
+def get_node_props(node):
+    
+    result = {k: v for k, v in get_node_attr(node).items()
+                        if k == "name" or (k in SCH_ATTRS and k != "children")}
+    
+    if not node.children: return result
+    
+    sorter = _get_node_sorter()
+    child_names = [child.name for child in sorted(node.children, key=sorter)]
+    result["children"] = child_names
+    
+    return result
+
+
 def _order_data(unordered):
     
     def key_sorter(d):
@@ -241,22 +1850,161 @@ def _order_data(unordered):
     return unordered
 
 
-def _get_doc_sorter(path=None, case_insenstive=True):
+def _read_journal(journal_path):
     
-    node_sorter = _get_node_sorter(case_insenstive)
+    if journal_path is None or not os.path.isfile(journal_path): return
     
-    def sorter(doc):
+    with open(journal_path, "r") as f:
+        lines = f.read().splitlines()
+    
+    for i, line in enumerate(lines):
         
-        tree = SCHTree.from_dict(dict(doc))
+        if not line.strip(): continue
         
-        if path is None:
-            node = tree.root_node
-        else:
-            node = tree.find_by_path(path)
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            # An interrupted append can only corrupt the final entry
+            if i == len(lines) - 1: return
+            raise
         
-        return node_sorter(node)
+        yield entry
+
+
+def _diff_tables(old, new):
     
-    return sorter
+    entries = []
+    
+    for table_name, docs in new.items():
+        
+        old_docs = old.get(table_name, {})
+        
+        for doc_id, doc in docs.items():
+            
+            if doc_id not in old_docs:
+                op = "insert"
+            elif old_docs[doc_id] is doc or old_docs[doc_id] == doc:
+                continue
+            else:
+                op = "replace"
+            
+            entries.append({"op": op,
+                            "table": table_name,
+                            "id": doc_id,
+                            "doc": _order_data(doc)})
+        
+        for doc_id in old_docs.keys() - docs.keys():
+            entries.append({"op": "remove",
+                            "table": table_name,
+                            "id": doc_id})
+    
+    for table_name in old.keys() - new.keys():
+        for doc_id in old[table_name]:
+            entries.append({"op": "remove",
+                            "table": table_name,
+                            "id": doc_id})
+    
+    return entries
+
+
+def _map_docs(func, view, docs):
+    
+    if view:
+        return [(doc_id, func(RecordView(doc))) for doc_id, doc in docs]
+    
+    return [(doc_id, func(SCHTree.from_dict(doc, compact=True)))
+                                                    for doc_id, doc in docs]
+
+
+def _return_record(record):
+    return record
+
+
+def _same_tables(new, old):
+    
+    if new.keys() != old.keys(): return False
+    
+    for table_name, docs in new.items():
+        
+        old_docs = old[table_name]
+        if docs.keys() != old_docs.keys(): return False
+        
+        for doc_id, doc in docs.items():
+            if old_docs[doc_id] is not doc and old_docs[doc_id] != doc:
+                return False
+    
+    return True
+
+
+def _load_json_file(path, codec_name=None):
+    with open(path, encoding="utf-8") as f:
+        return get_codec(codec_name).loads(f.read())
+
+
+def _copy_tables(data):
+    if data is None: return {}
+    return {name: dict(docs) for name, docs in data.items()}
+
+
+def _get_query_sql(query):
+    
+    sql = "SELECT DISTINCT doc_id FROM nodes WHERE path = ?"
+    params = [query.path]
+    
+    if query.value is None: return sql, params
+    
+    if query.exact:
+        sql += " AND value = ?"
+    else:
+        sql += " AND instr(value, ?) > 0"
+    
+    params.append(query.value)
+    
+    return sql, params
+
+
+def _get_row_props(name, value, attrs):
+    
+    props = {k: v for k, v in json.loads(attrs).items()
+                                        if k in SCH_ATTRS and k != "children"}
+    props["name"] = name
+    if value is not None: props["value"] = value
+    
+    return dict(sorted(props.items()))
+
+
+def _prune_doc(doc, paths, level_prefix="L"):
+    
+    if None in paths: return doc
+    
+    paths = [normalize_path(path) for path in paths]
+    
+    def keep(node_path):
+        for path in paths:
+            if (node_path == path or
+                path.startswith(node_path + '/') or
+                node_path.startswith(path + '/')): return True
+        return False
+    
+    # The root node is always kept so the result is a valid record
+    pruned = {f"{level_prefix}0": doc[f"{level_prefix}0"]}
+    level = 1
+    
+    while f"{level_prefix}{level}" in doc:
+        
+        nodes = [node for node in doc[f"{level_prefix}{level}"]
+                                        if keep(get_doc_node_path(node))]
+        if not nodes: break
+        
+        pruned[f"{level_prefix}{level}"] = nodes
+        level += 1
+    
+    return pruned
+
+
+def _lower(value):
+    if value is None: return None
+    return value.lower()
 
 
 def _get_node_sorter(case_insenstive=True):
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+SCALAR_TYPES = (str, int, float)
+CHOICE_INQUIRES = ("list", "checkbox")
+
+
+class PathIndex:
+    
+    def __init__(self, documents=None, level_prefix="L"):
+        
+        self._prefix = level_prefix
+        self._path_ids = defaultdict(set)
+        self._id_paths = {}
+        
+        if documents is None: return
+        
+        for doc_id, doc in documents:
+            self.add(doc_id, doc)
+    
+    def add(self, doc_id, doc):
+        
+        if doc_id in self._id_paths: self.discard(doc_id)
+        
+        paths = [path for path, _ in iter_doc_nodes(doc, self._prefix)]
+        
+        for path in paths:
+            self._path_ids[path].add(doc_id)
+        
+        self._id_paths[doc_id] = paths
+    
+    def discard(self, doc_id):
+        
+        paths = self._id_paths.pop(doc_id, [])
+        
+        for path in paths:
+            
+            doc_ids = self._path_ids[path]
+            doc_ids.discard(doc_id)
+            
+            if not doc_ids: del self._path_ids[path]
+    
+    def get(self, path):
+        return frozenset(self._path_ids.get(normalize_path(path), ()))
+    
+    def paths(self, doc_id):
+        return list(self._id_paths.get(doc_id, []))
+    
+    def __contains__(self, doc_id):
+        return doc_id in self._id_paths
+    
+    def __len__(self):
+        return len(self._id_paths)
+
+
+class ValueIndex:
+    
+    def __init__(self, documents=None, level_prefix="L", gram_size=3):
+        
+        self._prefix = level_prefix
+        self._n = gram_size
+        self._exact = defaultdict(lambda: defaultdict(set))
+        self._grams = defaultdict(lambda: defaultdict(set))
+        self._id_values = {}
+        
+        if documents is None: return
+        
+        for doc_id, doc in documents:
+            self.add(doc_id, doc)
+    
+    def add(self, doc_id, doc):
+        
+        if doc_id in self._id_values: self.discard(doc_id)
+        
+        values = {path: node["value"]
+                        for path, node in iter_doc_nodes(doc, self._prefix)
+                            if isinstance(node.get("value"), SCALAR_TYPES)}
+        
+        for path, value in values.items():
+            
+            self._exact[path][value].add(doc_id)
+            if not isinstance(value, str): continue
+            
+            for gram in get_ngrams(value, self._n):
+                self._grams[path][gram].add(doc_id)
+        
+        self._id_values[doc_id] = values
+    
+    def discard(self, doc_id):
+        
+        values = self._id_values.pop(doc_id, {})
+        
+        for path, value in values.items():
+            
+            _discard_key(self._exact[path], value, doc_id)
+            if not self._exact[path]: del self._exact[path]
+            if not isinstance(value, str): continue
+            
+            for gram in get_ngrams(value, self._n):
+                _discard_key(self._grams[path], gram, doc_id)
+            
+            if not self._grams[path]: del self._grams[path]
+    
+    def get(self, path, value, exact=False):
+        
+        path = normalize_path(path)
+        if path not in self._exact: return frozenset()
+        
+        if exact:
+            return frozenset(self._exact[path].get(value, ()))
+        
+        # Search strings shorter than the n-gram size can only be checked
+        # against the distinct values stored for the path
+        if len(value) < self._n:
+            return frozenset(doc_id
+                             for stored, doc_ids in self._exact[path].items()
+                                 if isinstance(stored, str) and
+                                    value in stored
+                                     for doc_id in doc_ids)
+        
+        grams = self._grams.get(path, {})
+        candidates = None
+        
+        for gram in get_ngrams(value, self._n):
+            
+            if gram not in grams: return frozenset()
+            
+            if candidates is None:
+                candidates = set(grams[gram])
+            else:
+                candidates &= grams[gram]
+            
+            if not candidates: return frozenset()
+        
+        # Matching n-grams do not guarantee a contiguous match
+        return frozenset(doc_id for doc_id in candidates
+                                     if value in self._id_values[doc_id][path])
+    
+    def items(self, path):
+        return ((value, frozenset(doc_ids)) for value, doc_ids in
+                            self._exact.get(normalize_path(path), {}).items())
+    
+    def __contains__(self, doc_id):
+        return doc_id in self._id_values
+    
+    def __len__(self):
+        return len(self._id_values)
+
+
+class BitmapIndex:
+    
+    def __init__(self, documents=None, level_prefix="L"):
+        
+        self._prefix = level_prefix
+        self._path_bits = {}
+        self._id_paths = {}
+        
+        if documents is None: return
+        
+        path_ids = defaultdict(list)
+        
+        for doc_id, doc in documents:
+            
+            paths = get_choice_paths(doc, self._prefix)
+            self._id_paths[doc_id] = paths
+            
+            for path in paths:
+                path_ids[path].append(doc_id)
+        
+        self._path_bits = {path: to_bitmap(doc_ids)
+                                        for path, doc_ids in path_ids.items()}
+    
+    def add(self, doc_id, doc):
+        
+        if doc_id in self._id_paths: self.discard(doc_id)
+        
+        paths = get_choice_paths(doc, self._prefix)
+        bit = 1 << doc_id
+        
+        for path in paths:
+            self._path_bits[path] = self._path_bits.get(path, 0) | bit
+        
+        self._id_paths[doc_id] = paths
+    
+    def discard(self, doc_id):
+        
+        bit = 1 << doc_id
+        
+        for path in self._id_paths.pop(doc_id, []):
+            
+            bits = self._path_bits[path] & ~bit
+            
+            if bits:
+                self._path_bits[path] = bits
+            else:
+                del self._path_bits[path]
+    
+    def get(self, path):
+        return self._path_bits.get(normalize_path(path), 0)
+    
+    def __contains__(self, path):
+        return normalize_path(path) in self._path_bits
+    
+    def __len__(self):
+        return len(self._path_bits)
+
+
+class KeyIndex:
+    """Map record root values to document ids.
+    
+    The index is not persisted. It is built in memory from documents that
+    have already been parsed, or from the root rows of an SQLite file, so
+    no trees are built. Until it is needed, SQLite and sharded databases
+    look keys up in storage, so adding a record does not read every
+    stored document.
+    """
+    
+    def __init__(self, documents=None, level_prefix="L"):
+        
+        self._prefix = level_prefix
+        self._key_ids = {}
+        self._id_keys = {}
+        
+        if documents is None: return
+        
+        for doc_id, doc in documents:
+            self.add(doc_id, doc)
+    
+    def add(self, doc_id, doc):
+        
+        if doc_id in self._id_keys: self.discard(doc_id)
+        
+        key = get_doc_key(doc, self._prefix)
+        if key is None: return
+        
+        # Stored records may already share a key, so new duplicates are
+        # only refused when records are written
+        self._key_ids.setdefault(key, set()).add(doc_id)
+        self._id_keys[doc_id] = key
+    
+    def discard(self, doc_id):
+        
+        key = self._id_keys.pop(doc_id, None)
+        if key is None: return
+        
+        doc_ids = self._key_ids[key]
+        doc_ids.discard(doc_id)
+        if not doc_ids: del self._key_ids[key]
+    
+    def get(self, key):
+        doc_ids = self._key_ids.get(key)
+        if not doc_ids: return None
+        return min(doc_ids)
+    
+    def get_ids(self, key):
+        return set(self._key_ids.get(key, ()))
+    
+    def keys(self):
+        return self._key_ids.keys()
+    
+    def __contains__(self, key):
+        return key in self._key_ids
+    
+    def __len__(self):
+        return len(self._key_ids)
+
+
+class SortIndex:
+    
+    def __init__(self, documents=None, level_prefix="L"):
+        
+        self._prefix = level_prefix
+        self._keys = []
+        self._id_keys = {}
+        
+        if documents is None: return
+        
+        for doc_id, doc in documents:
+            self._id_keys[doc_id] = get_doc_sort_key(doc, doc_id, self._prefix)
+        
+        self._keys = sorted(self._id_keys.values())
+    
+    def add(self, doc_id, doc):
+        
+        if doc_id in self._id_keys: self.discard(doc_id)
+        
+        key = get_doc_sort_key(doc, doc_id, self._prefix)
+        insort(self._keys, key)
+        self._id_keys[doc_id] = key
+    
+    def discard(self, doc_id):
+        
+        key = self._id_keys.pop(doc_id, None)
+        if key is None: return
+        
+        del self._keys[bisect_left(self._keys, key)]
+    
+    def __iter__(self):
+        return (key[-1] for key in self._keys)
+    
+    def __contains__(self, doc_id):
+        return doc_id in self._id_keys
+    
+    def __len__(self):
+        return len(self._id_keys)
+
+
+def get_doc_sort_key(doc, doc_id, level_prefix="L"):
+    
+    # Case insensitive root name then value, with missing values first and
+    # ties broken by document id
+    root = doc[f"{level_prefix}0"][0]
+    value = root.get("value")
+    
+    if value is None:
+        return (root["name"].lower(), False, "", doc_id)
+    
+    return (root["name"].lower(), True, value.lower(), doc_id)
+
+
+def get_doc_key(doc, level_prefix="L"):
+    return doc[f"{level_prefix}0"][0].get("value")
+
+
+def iter_doc_nodes(doc, level_prefix="L"):
+    
+    level = 0
+    
+    while f"{level_prefix}{level}" in doc:
+        
+        for node in doc[f"{level_prefix}{level}"]:
+            yield get_doc_node_path(node), node
+        
+        level += 1
+
+
+def get_doc_node_path(node):
+    
+    if node.get("parent"):
+        return normalize_path(f'{node["parent"]}/{node["name"]}')
+    
+    return normalize_path(node["name"])
+
+
+def get_choice_paths(doc, level_prefix="L"):
+    
+    # Choice fields and the options selected below them
+    nodes = dict(iter_doc_nodes(doc, level_prefix))
+    paths = []
+    
+    for path, node in nodes.items():
+        
+        parent = node.get("parent")
+        
+        if node.get("inquire") in CHOICE_INQUIRES:
+            paths.append(path)
+        elif (parent and
+              nodes[normalize_path(parent)].get("inquire") in CHOICE_INQUIRES):
+            paths.append(path)
+    
+    return paths
+
+
+def to_bitmap(doc_ids):
+    
+    doc_ids = list(doc_ids)
+    if not doc_ids: return 0
+    
+    data = bytearray(max(doc_ids) // 8 + 1)
+    
+    for doc_id in doc_ids:
+        data[doc_id >> 3] |= 1 << (doc_id & 7)
+    
+    return int.from_bytes(data, "little")
+
+
+def iter_bits(bits):
+    
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    
+    for i, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield i * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+def popcount(bits):
+    return bin(bits).count("1")
+
+
+def get_ngrams(value, n=3):
+    return set(value[i:i + n] for i in range(len(value) - n + 1))
+
+
+def normalize_path(path):
+    return path.strip('/')
+
+
+def _discard_key(mapping, key, doc_id):
+    
+    doc_ids = mapping.get(key)
+    if doc_ids is None: return
+    
+    doc_ids.discard(doc_id)
+    if not doc_ids: del mapping[key]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    
+    def __init__(self, path):
+        self._path = path
+    
+    @contextmanager
+    def shared(self):
+        with self._locked(exclusive=False):
+            yield
+    
+    @contextmanager
+    def exclusive(self):
+        with self._locked(exclusive=True):
+            yield
+    
+    @contextmanager
+    def _locked(self, exclusive):
+        
+        f = self._open(exclusive)
+        
+        if f is None:
+            yield
+            return
+        
+        with f:
+            
+            _lock_file(f, exclusive)
+            
+            try:
+                yield
+            finally:
+                _unlock_file(f)
+    
+    def _open(self, exclusive):
+        
+        if exclusive: return open(self._path, "a+")
+        
+        # Readers never create the lock file, so that reads leave nothing
+        # behind and work in read-only directories. Without the file, no
+        # writer has locked the database yet.
+        try:
+            return open(self._path, "r")
+        except OSError:
+            return None
+
+
+def _lock_file(f, exclusive):
+    
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return
+    
+    # Windows only offers exclusive locks, which are retried until free
+    f.seek(0)
+    
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            time.sleep(0.05)
+
+
+def _unlock_file(f):
+    
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return
+    
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
@@ -5,6 +5,7 @@ from itertools import chain, product
 import plotly.graph_objects as go
 
 from ..db import make_query
+from ..index import iter_bits, popcount
 
 
 class Sankey():
@@ -96,8 +97,7 @@ class Sankey():
     
         for k in names.keys():
             query = make_query(k)
-            memdb = self._db.search(query)
-            names_lookup[k] = memdb.to_records().keys()
+            names_lookup[k] = self._db.bitmap(query)
             
         return names_lookup
 
@@ -114,9 +114,9 @@ def get_links(prod, names_lookup):
         a = names_lookup[s]
         b = names_lookup[t]
         
-        match = list(set(a) & set(b))
-        count = len(match)
-        matches[t].extend(match)
+        match = a & b
+        count = popcount(match)
+        matches[t].extend(iter_bits(match))
 
         if count == 0: continue
 
@@ -138,7 +138,7 @@ def get_links_explicit(prod, names_lookup, matches):
         a = matches[s]
         b = names_lookup[t]
 
-        match = [1 if x in b else 0 for x in a]
+        match = [b >> x & 1 for x in a]
         count = sum(match)
 
         if count == 0: continue
@@ -170,10 +170,7 @@ def get_links_conservative(bnames, cnames, names_lookup, matches):
 
                 b = names_lookup[t]
 
-                if pid in b:
-                    hit.append(1)
-                else:
-                    hit.append(0)
+                hit.append(b >> pid & 1)
 
             hit = [x / sum(hit) if sum(hit) > 0 else 0 for x in hit]
             total_hits = [x + y for x, y in zip(hit, total_hits)]
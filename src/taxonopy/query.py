@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+import operator
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+from tinydb.queries import QueryInstance
+
+from .index import iter_doc_nodes, normalize_path
+
+COMPARISONS = {"!=": operator.ne,
+               "<": operator.lt,
+               "<=": operator.le,
+               ">": operator.gt,
+               ">=": operator.ge}
+OPERATORS = ["==", "!=", ">=", "<=", "=", ">", "<", "~"]
+PATH_END = "&|()!=<>~"
+VALUE_END = "&|()"
+QUOTES = "\"'"
+
+
+class IndexedQuery(QueryInstance, metaclass=ABCMeta):
+    
+    def __init__(self, hashval):
+        super().__init__(lambda doc: self._match(dict(iter_doc_nodes(doc)),
+                                                 getattr(doc, "doc_id", None)),
+                         hashval)
+    
+    @abstractmethod
+    def ids(self, db):
+        pass
+    
+    def bits(self, db):
+        return db._ids_bits(self)
+    
+    @abstractmethod
+    def _match(self, nodes, doc_id=None):
+        pass
+    
+    def __and__(self, other):
+        if not isinstance(other, IndexedQuery): return super().__and__(other)
+        return AndQuery(self, other)
+    
+    def __or__(self, other):
+        if not isinstance(other, IndexedQuery): return super().__or__(other)
+        return OrQuery(self, other)
+    
+    def __invert__(self):
+        return NotQuery(self)
+
+
+class NodeQuery(IndexedQuery):
+    
+    def __init__(self, path, value=None, exact=False):
+        
+        self.path = normalize_path(path)
+        self.value = value
+        self.exact = exact
+        
+        super().__init__(("node", self.path, value, exact))
+    
+    def ids(self, db):
+        if self.value is None: return db._path_ids(self.path)
+        return db._value_ids(self.path, self.value, self.exact)
+    
+    def bits(self, db):
+        if self.value is None: return db._path_bits(self.path)
+        return super().bits(db)
+    
+    def _match(self, nodes, doc_id=None):
+        
+        node = nodes.get(self.path)
+        
+        if node is None: return False
+        if self.value is None: return True
+        if "value" not in node: return False
+        
+        if self.exact:
+            return node["value"] == self.value
+        
+        return (isinstance(node["value"], str) and
+                self.value in node["value"])
+
+
+class CompareQuery(IndexedQuery):
+    
+    def __init__(self, path, op, value):
+        
+        if op not in COMPARISONS:
+            raise ValueError(f"Unknown comparison operator '{op}'")
+        
+        self.path = normalize_path(path)
+        self.op = op
+        self.value = value
+        
+        super().__init__(("compare", self.path, op, value))
+    
+    def ids(self, db):
+        return db._compare_ids(self.path, self.op, self.value)
+    
+    def _match(self, nodes, doc_id=None):
+        
+        node = nodes.get(self.path)
+        if node is None or "value" not in node: return False
+        
+        return compare_values(node["value"], self.op, self.value)
+
+
+class IdQuery(IndexedQuery):
+    
+    def __init__(self, doc_ids):
+        
+        self.doc_ids = frozenset(doc_ids)
+        
+        # A fixed set of documents is not cached, as it can not be kept
+        # up to date when documents change
+        super().__init__(None)
+    
+    def ids(self, db):
+        return self.doc_ids
+    
+    def _match(self, nodes, doc_id=None):
+        return doc_id in self.doc_ids
+
+
+class NotQuery(IndexedQuery):
+    
+    def __init__(self, query):
+        self.query = query
+        super().__init__(_combine_hash("not", [query]))
+    
+    def ids(self, db):
+        return db._all_ids() - self.query.ids(db)
+    
+    def bits(self, db):
+        return db._all_bits() & ~self.query.bits(db)
+    
+    def _match(self, nodes, doc_id=None):
+        return not self.query._match(nodes, doc_id)
+
+
+class AndQuery(IndexedQuery):
+    
+    def __init__(self, *queries):
+        self.queries = _flatten(queries, AndQuery)
+        super().__init__(_combine_hash("and", self.queries))
+    
+    def ids(self, db):
+        
+        # Negated terms are subtracted from the positive matches rather than
+        # being expanded against every document
+        positive = [q for q in self.queries if not isinstance(q, NotQuery)]
+        negative = [q.query for q in self.queries if isinstance(q, NotQuery)]
+        
+        if positive:
+            result = None
+        else:
+            result = set(db._all_ids())
+        
+        for query in positive:
+            
+            if result is None:
+                result = set(query.ids(db))
+            else:
+                result &= query.ids(db)
+            
+            if not result: return frozenset()
+        
+        for query in negative:
+            result -= query.ids(db)
+            if not result: break
+        
+        return frozenset(result)
+    
+    def bits(self, db):
+        
+        result = -1
+        
+        for query in self.queries:
+            result &= query.bits(db)
+            if not result: break
+        
+        return result
+    
+    def _match(self, nodes, doc_id=None):
+        return all(query._match(nodes, doc_id) for query in self.queries)
+
+
+class OrQuery(IndexedQuery):
+    
+    def __init__(self, *queries):
+        self.queries = _flatten(queries, OrQuery)
+        super().__init__(_combine_hash("or", self.queries))
+    
+    def ids(self, db):
+        
+        result = set()
+        
+        for query in self.queries:
+            result |= query.ids(db)
+        
+        return frozenset(result)
+    
+    def bits(self, db):
+        
+        result = 0
+        
+        for query in self.queries:
+            result |= query.bits(db)
+        
+        return result
+    
+    def _match(self, nodes, doc_id=None):
+        return any(query._match(nodes, doc_id) for query in self.queries)
+
+
+class QueryCache:
+    
+    def __init__(self, max_size=128):
+        self._max_size = max_size
+        self._results = OrderedDict()
+    
+    def get(self, query):
+        
+        if not query.is_cacheable(): return None
+        
+        result = self._results.get(query._hash)
+        if result is None: return None
+        
+        self._results.move_to_end(query._hash)
+        
+        return result[1]
+    
+    def put(self, query, doc_ids):
+        
+        if not query.is_cacheable() or self._max_size < 1: return
+        
+        self._results[query._hash] = (query, frozenset(doc_ids))
+        self._results.move_to_end(query._hash)
+        
+        while len(self._results) > self._max_size:
+            self._results.popitem(last=False)
+    
+    def add(self, doc_id, doc):
+        
+        if not self._results: return
+        
+        # Re-test only the changed document against each cached query
+        nodes = dict(iter_doc_nodes(doc))
+        
+        for key, (query, doc_ids) in list(self._results.items()):
+            
+            matched = query._match(nodes, doc_id)
+            if matched == (doc_id in doc_ids): continue
+            
+            if matched:
+                doc_ids = doc_ids | {doc_id}
+            else:
+                doc_ids = doc_ids - {doc_id}
+            
+            self._results[key] = (query, doc_ids)
+    
+    def discard(self, doc_id):
+        for key, (query, doc_ids) in list(self._results.items()):
+            if doc_id not in doc_ids: continue
+            self._results[key] = (query, doc_ids - {doc_id})
+    
+    def clear(self):
+        self._results.clear()
+    
+    def __len__(self):
+        return len(self._results)
+
+
+class QueryParser:
+    
+    def __init__(self, text):
+        self._text = text
+        self._pos = 0
+    
+    def parse(self):
+        
+        query = self._parse_or()
+        self._skip_space()
+        
+        if self._pos < len(self._text):
+            self._error(f"unexpected '{self._text[self._pos]}'")
+        
+        return query
+    
+    def _parse_or(self):
+        
+        queries = [self._parse_and()]
+        
+        while self._accept("|"):
+            queries.append(self._parse_and())
+        
+        if len(queries) == 1: return queries[0]
+        
+        return OrQuery(*queries)
+    
+    def _parse_and(self):
+        
+        queries = [self._parse_not()]
+        
+        while self._accept("&"):
+            queries.append(self._parse_not())
+        
+        if len(queries) == 1: return queries[0]
+        
+        return AndQuery(*queries)
+    
+    def _parse_not(self):
+        
+        if self._accept("!"): return NotQuery(self._parse_not())
+        if not self._accept("("): return self._parse_term()
+        
+        query = self._parse_or()
+        if not self._accept(")"): self._error("expected ')'")
+        
+        return query
+    
+    def _parse_term(self):
+        
+        self._skip_space()
+        
+        # Paths containing operator characters must be quoted
+        if self._pos < len(self._text) and self._text[self._pos] in QUOTES:
+            path = self._read_quoted()
+        else:
+            path = self._read_until(PATH_END).strip()
+        
+        if not path: self._error("expected a path")
+        
+        op = self._read_operator()
+        if op is None: return NodeQuery(path)
+        
+        value = self._read_value()
+        
+        if op in ("=", "=="): return NodeQuery(path, value, exact=True)
+        if op == "~": return NodeQuery(path, value)
+        
+        return CompareQuery(path, op, value)
+    
+    def _read_operator(self):
+        
+        self._skip_space()
+        
+        for op in OPERATORS:
+            if self._text.startswith(op, self._pos):
+                self._pos += len(op)
+                return op
+        
+        return None
+    
+    def _read_value(self):
+        
+        self._skip_space()
+        
+        if self._pos < len(self._text) and self._text[self._pos] in QUOTES:
+            return self._read_quoted()
+        
+        value = self._read_until(VALUE_END).strip()
+        if not value: self._error("expected a value")
+        
+        return value
+    
+    def _read_quoted(self):
+        
+        quote = self._text[self._pos]
+        end = self._text.find(quote, self._pos + 1)
+        if end < 0: self._error("unterminated string")
+        
+        value = self._text[self._pos + 1:end]
+        self._pos = end + 1
+        
+        return value
+    
+    def _read_until(self, chars):
+        
+        start = self._pos
+        
+        while (self._pos < len(self._text) and
+               self._text[self._pos] not in chars):
+            self._pos += 1
+        
+        return self._text[start:self._pos]
+    
+    def _accept(self, char):
+        
+        self._skip_space()
+        
+        if not self._text.startswith(char, self._pos): return False
+        if char == "!" and self._text.startswith("!=", self._pos):
+            return False
+        
+        self._pos += 1
+        
+        return True
+    
+    def _skip_space(self):
+        while self._pos < len(self._text) and self._text[self._pos].isspace():
+            self._pos += 1
+    
+    def _error(self, msg):
+        raise ValueError(f"Invalid query at position {self._pos}: {msg}")
+
+
+def parse_query(text):
+    return QueryParser(text).parse()
+
+
+def compare_values(stored, op, value):
+    
+    # Text inequality is exact, matching the '=' operator
+    if op == "!=" and isinstance(stored, str): return stored != value
+    
+    try:
+        return COMPARISONS[op](float(stored), float(value))
+    except (TypeError, ValueError):
+        return COMPARISONS[op](str(stored), value)
+
+
+def _combine_hash(name, queries):
+    
+    if not all(query.is_cacheable() for query in queries): return None
+    if name == "not": return (name, queries[0]._hash)
+    
+    return (name, frozenset(query._hash for query in queries))
+
+
+def _flatten(queries, query_cls):
+    
+    result = []
+    
+    for query in queries:
+        if isinstance(query, query_cls):
+            result.extend(query.queries)
+        else:
+            result.append(query)
+    
+    return result
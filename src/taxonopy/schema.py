@@ -1,6 +1,6 @@
 
 import os
-import json
+import hashlib
 import datetime as dt
 import textwrap
 from abc import ABC, abstractmethod
@@ -9,16 +9,29 @@ from collections import OrderedDict
 
 from anytree import (ContStyle,
                      LevelOrderGroupIter,
+                     LoopError,
                      Node,
-                     PreOrderIter,
                      RenderTree)
 from anytree.exporter import UniqueDotExporter
 from anytree.resolver import ChildResolverError, Resolver
 from anytree.search import findall
 from tabulate import tabulate
 
+from .codec import get_codec
+from .index import iter_doc_nodes, normalize_path
+
 # TODO make the color scheme dynamic
 COLOR_SCHEME = ["aliceblue", "antiquewhite", "azure", "coral", "palegreen"]
+SCH_ATTRS = ["type",
+             "default",
+             "value",
+             "inquire",
+             "required",
+             "import",
+             "children",
+             "long_attrs",
+             "description"]
+_MISSING = object()
 
 
 class Tree:
@@ -26,40 +39,58 @@ class Tree:
     def __init__(self, root_node=None,
                        short_attrs=None,
                        long_attrs=None,
-                       level_prefix="L"):
+                       level_prefix="L",
+                       compact=False):
         self.root_node = root_node
         self.short_attrs = (set([]) if short_attrs is None
                                                         else set(short_attrs))
         self.long_attrs = (set([]) if long_attrs is None else set(long_attrs))
         self.prefix = level_prefix
+        self._node_cls = CompactNode if compact else TreeNode
+        self._nodes = {}
     
     @classmethod
-    def from_dict(cls, data, level_prefix="L"):
-        
-        data = deepcopy(data)
+    def from_dict(cls, data, level_prefix="L", compact=False):
         
-        n_levels = len(list(data.keys()))
-        new_tree = cls(level_prefix)
+        n_levels = len(data)
+        new_tree = cls(level_prefix=level_prefix, compact=compact)
         
         # read the root node
         root = data[f"{new_tree.prefix}0"][0]
         assert "name" in root
-        name = root.pop("name")
-        new_tree.add_node(name, **root)
+        attrs = {key: value for key, value in root.items() if key != "name"}
+        new_tree.add_node(root["name"], **attrs)
+        
+        # populate the tree in a single pass, finding each parent from the
+        # nodes already created rather than resolving it from the root
+        paths = new_tree._nodes
         
-        # populate the tree
         for k in range(1, n_levels):
             
             key = f"{new_tree.prefix}{k}"
-            nodes = data[key]
             
-            for n in nodes:
+            for n in data[key]:
                 
                 assert "name" in n
                 assert "parent" in n
-                name = n.pop("name")
-                parent = n.pop("parent")
-                new_tree.add_node(name, parent, **n)
+                name = n["name"]
+                parent = n["parent"].strip('/')
+                
+                parent_node = paths.get(parent)
+                if parent_node is None:
+                    parent_node = new_tree.find_by_path(parent)
+                
+                attrs = new_tree._filter_attrs(
+                                {key: value for key, value in n.items()
+                                        if key != "name" and key != "parent"})
+                new_tree._add_attr_names(attrs)
+                
+                node = type(parent_node)(name, parent=parent_node, **attrs)
+                paths.setdefault(f"{parent}/{name}", node)
+        
+        # Compact trees give up the path table to save memory, so paths
+        # are only stored once they are looked up
+        if compact: new_tree._nodes = {}
         
         return new_tree
     
@@ -88,7 +119,7 @@ class Tree:
         file_name: str with the name of the file containing the taxonomy
         """
         
-        data = json.loads(_get_data(filepath_or_data))
+        data = get_codec().loads(_get_data(filepath_or_data))
         new_tree = cls.from_dict(data, level_prefix)
         
         return new_tree
@@ -98,6 +129,7 @@ class Tree:
         if self.root_node is None: return {}
         
         output_dict = OrderedDict()
+        attrs = sorted(self.short_attrs.union(self.long_attrs))
         
         for i, children in enumerate(LevelOrderGroupIter(self.root_node)):
             
@@ -116,9 +148,10 @@ class Tree:
                     
                     node_dict["parent"] = parent_path
                 
-                for attr in sorted(self.short_attrs.union(self.long_attrs)):
-                    if hasattr(node, attr):
-                        node_dict[attr] = getattr(node, attr)
+                values = _get_attr_values(node)
+                
+                for attr in attrs:
+                    if attr in values: node_dict[attr] = values[attr]
                 
                 node_list.append(node_dict)
             
@@ -163,7 +196,7 @@ class Tree:
     def to_json(self, file_name=None):
         
         output_dict = self.to_dict()
-        json_text = json.dumps(output_dict, indent=4)
+        json_text = get_codec().dumps(output_dict, pretty=True)
         
         if file_name is None:
             return json_text
@@ -210,36 +243,46 @@ class Tree:
     
     def find_by_path(self, path) -> Node:
         
-        r = Resolver()
-        path_resolution = path.strip('/').split('/')
+        path = path.strip('/')
         
-        if (len(path_resolution) == 1 and
-            self.root_node.name == path_resolution[0]):
-            return self.root_node
-        elif len(path_resolution) == 1:
-            raise ChildResolverError(self.root_node, path, 'name')
+        node = self._nodes.get(path)
+        if node is not None and self._is_node_path(node, path): return node
         
-        path_relative = '/'.join(path_resolution[1:])
+        node = self._resolve_path(path)
+        self._nodes[path] = node
         
-        return r.get(self.root_node, path_relative)
+        return node
     
     def add_node(self, name, parent=None, children=None, **kwargs):
         
-        if "long_attrs" in kwargs:
-            self.long_attrs |= set(kwargs["long_attrs"])
-        
-        self.short_attrs |= set(kwargs.keys()) - self.long_attrs
+        self._add_attr_names(kwargs)
         
         if parent is None:
-            self.root_node = Node(name, children=children, **kwargs)
+            self.root_node = self._node_cls(name, children=children, **kwargs)
+            self._nodes = {str(name): self.root_node}
             return
         
         parent_node = self.find_by_path(parent)
-        Node(name, parent=parent_node, children=children, **kwargs)
+        node = type(parent_node)(name,
+                                 parent=parent_node,
+                                 children=children,
+                                 **kwargs)
+        
+        # The first child with a given name is the one found by path
+        self._nodes.setdefault(f"{parent.strip('/')}/{name}", node)
     
     def delete_node(self, path):
         node = self.find_by_path(path)
         node.parent = None
+        self._forget_path(path)
+    
+    def move_node(self, path, parent):
+        
+        node = self.find_by_path(path)
+        node.parent = self.find_by_path(parent)
+        
+        self._forget_path(path)
+        self._nodes[f"{parent.strip('/')}/{node.name}"] = node
     
     def update_node(self, path, **kwargs):
         
@@ -247,68 +290,85 @@ class Tree:
         
         for attr, value in kwargs.items():
             setattr(node, attr, value)
+        
+        if "name" in kwargs: self._forget_path(path)
+    
+    def _filter_attrs(self, attrs):
+        return attrs
+    
+    def _add_attr_names(self, attrs):
+        
+        if "long_attrs" in attrs:
+            self.long_attrs |= set(attrs["long_attrs"])
+        
+        self.short_attrs |= set(attrs.keys()) - self.long_attrs
     
-    def diff(self, other):
+    def _resolve_path(self, path):
+        
+        r = Resolver()
+        path_resolution = path.split('/')
+        
+        if (len(path_resolution) == 1 and
+            self.root_node.name == path_resolution[0]):
+            return self.root_node
+        elif len(path_resolution) == 1:
+            raise ChildResolverError(self.root_node, path, 'name')
+        
+        path_relative = '/'.join(path_resolution[1:])
+        
+        return r.get(self.root_node, path_relative)
+    
+    def _is_node_path(self, node, path):
+        
+        # Nodes can also be moved or renamed directly, so the stored node
+        # is checked against its ancestors before it is used
+        names = path.split('/')
+        
+        for name in reversed(names[1:]):
+            if str(node.name) != name: return False
+            node = node.parent
+            if node is None: return False
+        
+        return node is self.root_node and str(node.name) == names[0]
+    
+    def _forget_path(self, path):
+        
+        path = path.strip('/')
+        prefix = f"{path}/"
+        
+        self._nodes = {key: node for key, node in self._nodes.items()
+                            if key != path and not key.startswith(prefix)}
+    
+    def diff(self, other, detail=False):
         
         # Can only be compared with another Tree
         if not isinstance(other, Tree):
             raise ValueError("Comparison only valid to another Tree object")
         
         diff = {}
+        attrs = sorted(self.short_attrs | self.long_attrs |
+                       other.short_attrs | other.long_attrs)
         
-        deleted = "deleted"
-        added = "added"
-        changed = "changed"
+        _diff_children("",
+                       _map_children([self.root_node]),
+                       _map_children([other.root_node]),
+                       attrs,
+                       diff)
         
-        # Check for added and deleted nodes
-        flat_nodes = [node for node in PreOrderIter(self.root_node)]
-        node_paths = [get_node_path(node) for node in flat_nodes]
-        other_node_paths = [get_node_path(node)
-                                    for node in PreOrderIter(other.root_node)]
+        if detail: return diff
         
-        for path in (set(node_paths) - set(other_node_paths)):
-            diff[path] = deleted
-        
-        for path in (set(other_node_paths) - set(node_paths)):
-            diff[path] = added
+        return {path: change for path, (change, _) in diff.items()}
+    
+    def get_hash(self, path=None):
         
-        # Check for changed nodes
-        for path in (set(node_paths) & set(other_node_paths)):
-            
-            this_node = self.find_by_path(path)
-            other_node = other.find_by_path(path)
-            
-            matching = True
-            
-            for attr in self.short_attrs.union(self.long_attrs):
-                
-                if ((hasattr(this_node, attr) and
-                     not hasattr(other_node, attr)) or
-                    (not hasattr(this_node, attr) and
-                     hasattr(other_node, attr))):
-                    
-                    matching = False
-                    break
-                
-                elif (not hasattr(this_node, attr) or
-                      not hasattr(other_node, attr)):
-                    
-                    continue
-                
-                this_attr = getattr(this_node, attr)
-                other_attr = getattr(other_node, attr)
-                
-                if this_attr == other_attr: continue
-                matching = False
-                break
-            
-            if matching: continue
-            diff[path] = changed
+        if self.root_node is None: return None
+        if path is None: return get_node_hash(self.root_node)
         
-        return diff
+        return get_node_hash(self.find_by_path(path))
     
     def __eq__(self, other):
         if not isinstance(other, Tree): return False
+        if self.get_hash() == other.get_hash(): return True
         return not self.diff(other)
     
     def __str__(self):
@@ -320,22 +380,10 @@ class Tree:
 class SCHTree(Tree):
     
     def add_node(self, name, parent=None, **kwargs):
-        
-        data = {}
-        extra_keys = ["type",
-                      "default",
-                      "value",
-                      "inquire",
-                      "required",
-                      "import",
-                      "children",
-                      "long_attrs",
-                      "description"]
-        
-        for key in extra_keys:
-            if key in kwargs: data[key] = kwargs[key]
-        
-        super().add_node(name, parent, **data)
+        super().add_node(name, parent, **self._filter_attrs(kwargs))
+    
+    def _filter_attrs(self, attrs):
+        return {key: attrs[key] for key in SCH_ATTRS if key in attrs}
     
     def to_dot(self, file_name=None, root_path=None):
         
@@ -380,6 +428,299 @@ class SCHTree(Tree):
                 f.write(msg + "\n")
 
 
+class RecordView:
+    
+    def __init__(self, data, level_prefix="L"):
+        self._data = data
+        self.prefix = level_prefix
+        self._nodes = None
+        self._children = None
+        self._hash = None
+    
+    @property
+    def root_node(self):
+        
+        nodes = self._data.get(f"{self.prefix}0")
+        if not nodes: return None
+        
+        root = nodes[0]
+        
+        return NodeView(self, normalize_path(root["name"]), root)
+    
+    def to_dict(self):
+        return self._data
+    
+    def get_hash(self, path=None):
+        
+        if path is not None: return get_node_hash(self.find_by_path(path))
+        
+        # The record hash is found from the stored nodes, as building node
+        # views for every node is slower
+        if self._hash is None and self._data.get(f"{self.prefix}0"):
+            self._hash = _get_doc_hash(self._data, self.prefix)
+        
+        return self._hash
+    
+    def find_by_path(self, path):
+        
+        path = normalize_path(path)
+        self._map_nodes()
+        
+        if path in self._nodes: return self._get_node(path)
+        
+        # Match the error raised by Tree.find_by_path
+        path_resolution = path.split('/')
+        node = self.root_node
+        
+        for i in range(1, len(path_resolution)):
+            child_path = '/'.join(path_resolution[:i + 1])
+            if child_path not in self._nodes: break
+            node = self._get_node(child_path)
+        
+        raise ChildResolverError(node, path, 'name')
+    
+    def _get_node(self, path):
+        return NodeView(self, path, self._nodes[path])
+    
+    def _get_children(self, path):
+        self._map_nodes()
+        return [self._get_node(child) for child in self._children.get(path,
+                                                                      [])]
+    
+    def _map_nodes(self):
+        
+        if self._nodes is not None: return
+        
+        self._nodes = {}
+        self._children = {}
+        
+        for path, node in iter_doc_nodes(self._data, self.prefix):
+            
+            self._nodes[path] = node
+            parent = node.get("parent")
+            
+            if parent:
+                self._children.setdefault(normalize_path(parent),
+                                          []).append(path)
+    
+    def _get_node_attrs(self):
+        
+        self._map_nodes()
+        
+        return {path: {k: v for k, v in node.items() if k != "parent"}
+                                        for path, node in self._nodes.items()}
+    
+    def __eq__(self, other):
+        if not isinstance(other, RecordView): return NotImplemented
+        if self._data == other._data: return True
+        
+        # Hashes are only compared once they are known
+        if self._hash is not None and self._hash == other._hash: return True
+        
+        return self._get_node_attrs() == other._get_node_attrs()
+
+
+class TreeNode(Node):
+    
+    # Cached content hashes are cleared by every change to a node or its
+    # children, including changes made directly rather than through a Tree
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+        if attr != "_content_hash" and self.__dict__.get("_content_hash"):
+            _clear_hashes(self)
+    
+    def _pre_detach(self, parent):
+        _clear_hashes(parent)
+    
+    def _post_attach(self, parent):
+        _clear_hashes(parent)
+
+
+class CompactNode:
+    
+    __slots__ = ("name", "_parent", "_children", "_attrs", "_content_hash")
+    separator = "/"
+    
+    def __init__(self, name, parent=None, children=None, **kwargs):
+        
+        set_slot = object.__setattr__
+        set_slot(self, "name", name)
+        set_slot(self, "_parent", parent)
+        set_slot(self, "_children", ())
+        set_slot(self, "_attrs", kwargs or None)
+        set_slot(self, "_content_hash", None)
+        
+        # A new node has no children yet, so it can not create a loop
+        if parent is not None: parent._add_child(self)
+        if children: self.children = children
+    
+    @property
+    def parent(self):
+        return self._parent
+    
+    @parent.setter
+    def parent(self, value):
+        
+        if value is self._parent: return
+        
+        if value is not None:
+            for node in value.path:
+                if node is self:
+                    raise LoopError(f"Cannot set parent. {self!r} is an "
+                                    f"ancestor of {value!r}")
+        
+        if self._parent is not None:
+            _clear_hashes(self._parent)
+            children = self._parent._children
+            del children[next(i for i, child in enumerate(children)
+                                                        if child is self)]
+        
+        if value is not None: value._add_child(self)
+        object.__setattr__(self, "_parent", value)
+    
+    @property
+    def children(self):
+        return tuple(self._children)
+    
+    @children.setter
+    def children(self, children):
+        
+        for child in self.children:
+            child.parent = None
+        
+        for child in children:
+            child.parent = self
+    
+    @property
+    def path(self):
+        
+        path = []
+        node = self
+        
+        while node is not None:
+            path.append(node)
+            node = node._parent
+        
+        return tuple(reversed(path))
+    
+    @property
+    def ancestors(self):
+        return self.path[:-1]
+    
+    @property
+    def root(self):
+        return self.path[0]
+    
+    @property
+    def depth(self):
+        return len(self.path) - 1
+    
+    @property
+    def is_leaf(self):
+        return not self._children
+    
+    @property
+    def is_root(self):
+        return self._parent is None
+    
+    def items(self):
+        yield "name", self.name
+        if self._attrs: yield from self._attrs.items()
+    
+    def _add_child(self, child):
+        
+        # Leaves share an empty tuple rather than holding their own list
+        if not self._children: object.__setattr__(self, "_children", [])
+        self._children.append(child)
+        _clear_hashes(self)
+    
+    def __getattr__(self, attr):
+        
+        if attr.startswith("_"): raise AttributeError(attr)
+        
+        attrs = self._attrs
+        if attrs is None or attr not in attrs: raise AttributeError(attr)
+        
+        return attrs[attr]
+    
+    def __setattr__(self, attr, value):
+        
+        if attr in CompactNode.__slots__ or attr in ("parent", "children"):
+            object.__setattr__(self, attr, value)
+        else:
+            if self._attrs is None: object.__setattr__(self, "_attrs", {})
+            self._attrs[attr] = value
+        
+        if attr != "_content_hash": _clear_hashes(self)
+    
+    def __repr__(self):
+        return f"{type(self).__name__}({get_node_path(self)!r})"
+
+
+class NodeView:
+    
+    __slots__ = ("_record", "_path", "_data")
+    separator = "/"
+    
+    def __init__(self, record, path, data):
+        self._record = record
+        self._path = path
+        self._data = data
+    
+    @property
+    def name(self):
+        return self._data["name"]
+    
+    @property
+    def parent(self):
+        
+        parent = self._data.get("parent")
+        if not parent: return None
+        
+        return self._record.find_by_path(parent)
+    
+    @property
+    def children(self):
+        return tuple(self._record._get_children(self._path))
+    
+    @property
+    def path(self):
+        
+        path_resolution = self._path.split('/')
+        
+        return tuple(self._record.find_by_path(
+                                        '/'.join(path_resolution[:i + 1]))
+                                    for i in range(len(path_resolution)))
+    
+    @property
+    def depth(self):
+        return self._path.count('/')
+    
+    def items(self):
+        return ((key, value) for key, value in self._data.items()
+                                                        if key != "parent")
+    
+    def __getattr__(self, attr):
+        
+        if attr.startswith("_") or attr == "parent":
+            raise AttributeError(attr)
+        
+        try:
+            return self._data[attr]
+        except KeyError:
+            raise AttributeError(attr) from None
+    
+    def __eq__(self, other):
+        if not isinstance(other, NodeView): return NotImplemented
+        return self._record is other._record and self._path == other._path
+    
+    def __hash__(self):
+        return hash((id(self._record), self._path))
+    
+    def __repr__(self):
+        return f"{type(self).__name__}({'/' + self._path!r})"
+
+
 class RecordBuilderBase(ABC):
     
     def __init__(self, schema):
@@ -432,6 +773,41 @@ def get_node_path(node):
     return node.separator.join([""] + [str(x.name) for x in node.path])
 
 
+def get_path_nodes(root):
+    
+    if root is None: return {}
+    
+    nodes = {}
+    stack = [(get_node_path(root), root)]
+    
+    # The first of any nodes sharing a path is kept, as for find_by_path
+    while stack:
+        
+        path, node = stack.pop()
+        nodes.setdefault(path, node)
+        
+        stack.extend((f"{path}{child.separator}{child.name}", child)
+                                        for child in reversed(node.children))
+    
+    return nodes
+
+
+def get_node_hash(node):
+    
+    digest = getattr(node, "_content_hash", None)
+    if digest is not None: return digest
+    
+    child_digests = [get_node_hash(child) for child in node.children]
+    digest = _hash_node(node.name,
+                        _get_attr_values(node),
+                        child_digests)
+    
+    # Only nodes that clear their hash when changed can keep it
+    if isinstance(node, (TreeNode, CompactNode)): node._content_hash = digest
+    
+    return digest
+
+
 def copy_node(node, extra_attrs, orphan=False):
     
     children = None
@@ -439,7 +815,7 @@ def copy_node(node, extra_attrs, orphan=False):
                           for attr in extra_attrs if hasattr(node, attr)}
     if not orphan: children = deepcopy(node.children)
     
-    return Node(node.name, children=children, **kwargs)
+    return type(node)(node.name, children=children, **kwargs)
 
 
 def render_node(root, short_attrs=None, long_attrs=None):
@@ -452,15 +828,16 @@ def render_node(root, short_attrs=None, long_attrs=None):
     for pre, fill, node in RenderTree(root):
         
         msg += f"{pre}{node.name}"
+        values = _get_attr_values(node)
         
         for attr in short_attrs:
-            if hasattr(node, attr):
-                msg += f" {attr}={getattr(node, attr)}"
+            if attr in values:
+                msg += f" {attr}={values[attr]}"
         
         msg += "\n"
         
         for attr in long_attrs:
-            if hasattr(node, attr):
+            if attr in values:
                 msg += render_lines(fill, node, attr)
     
     return msg
@@ -505,10 +882,15 @@ def get_node_attr(node, blacklist=None):
     
     if blacklist is None: blacklist = []
     
+    if isinstance(node, (NodeView, CompactNode)):
+        items = node.items()
+    else:
+        items = node.__dict__.items()
+    
     return {key: value for key, value in filter(
                 lambda item: not item[0].startswith("_") and
                              item[0] not in blacklist,
-                    sorted(node.__dict__.items(), key=lambda item: item[0]))}
+                    sorted(items, key=lambda item: item[0]))}
 
 
 def record_has_node(record, node_path):
@@ -628,6 +1010,101 @@ def document(nodes,
     return msgs
 
 
+def _get_attr_values(node):
+    
+    if isinstance(node, CompactNode): return node._attrs or {}
+    if isinstance(node, NodeView): return dict(node.items())
+    return vars(node)
+
+
+def _get_doc_hash(doc, level_prefix="L"):
+    
+    # Gives the hash of the tree built from the document, working up from
+    # the deepest level so each node follows its children
+    child_digests = {}
+    digest = None
+    
+    for path, node in reversed(list(iter_doc_nodes(doc, level_prefix))):
+        
+        digest = _hash_node(node["name"],
+                            node,
+                            child_digests.pop(path, []))
+        parent = node.get("parent")
+        
+        if parent:
+            child_digests.setdefault(normalize_path(parent),
+                                     []).append(digest)
+    
+    return digest
+
+
+def _hash_node(name, attrs, child_digests):
+    
+    # Child hashes are sorted, as paths do not depend on the order of
+    # siblings
+    attrs = sorted((key, value) for key, value in attrs.items()
+                        if key[0] != "_" and key != "name" and key != "parent")
+    content = repr((name, attrs, sorted(child_digests)))
+    
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def _clear_hashes(node):
+    
+    # The hash of each ancestor depends on the hashes of its descendants,
+    # and a node without a hash has no ancestors with one
+    while getattr(node, "_content_hash", None) is not None:
+        node._content_hash = None
+        node = node.parent
+
+
+def _map_children(nodes):
+    
+    children = {}
+    
+    for node in nodes:
+        if node is None: continue
+        children.setdefault(str(node.name), node)
+    
+    return children
+
+
+def _diff_children(parent_path, children, other_children, attrs, diff):
+    
+    for name, node in children.items():
+        
+        other_node = other_children.get(name)
+        
+        if other_node is None:
+            diff.update((path, ("deleted", ()))
+                                            for path in get_path_nodes(node))
+            continue
+        
+        # Identical branches are skipped if both hashes are already known,
+        # such as after an equality check
+        digest = getattr(node, "_content_hash", None)
+        if (digest is not None and
+            digest == getattr(other_node, "_content_hash", None)): continue
+        
+        path = f"{parent_path}{node.separator}{name}"
+        changed_attrs = tuple(attr for attr in attrs
+                                        if getattr(node, attr, _MISSING) !=
+                                           getattr(other_node, attr, _MISSING))
+        
+        if changed_attrs: diff[path] = ("changed", changed_attrs)
+        
+        _diff_children(path,
+                       _map_children(node.children),
+                       _map_children(other_node.children),
+                       attrs,
+                       diff)
+    
+    for name, other_node in other_children.items():
+        if name in children: continue
+        diff.update((path, ("added", ()))
+                                    for path in get_path_nodes(other_node))
+
+
 def _get_data(filepath_or_data):
     
     if _file_exists(filepath_or_data):
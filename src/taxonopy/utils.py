@@ -2,21 +2,26 @@
 
 import os
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import yaml
 import graphviz
 from yaml import dump
 from anytree import PreOrderIter
-from anytree.exporter import DictExporter
 from slugify import slugify
 from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 from openpyxl.drawing.image import Image
 
-from .db import JSONDataBase, make_query
+from .db import (PARALLEL_CHUNK_SIZE,
+                 is_parallel,
+                 make_query,
+                 open_database)
+from .index import popcount
 from .schema import (RecordBuilderBase,
+                     RecordView,
                      SCHTree,
                      copy_node_to_record,
                      get_node_attr,
@@ -279,7 +284,7 @@ class IndentDumper(yaml.Dumper):
 
 
 def get_root_value_ids(db):
-    return {v.root_node.value: k for k, v in db.to_records().items()}
+    return {key: db.get_by_key(key) for key in db.keys()}
 
 
 def dump_xl(out,
@@ -287,7 +292,8 @@ def dump_xl(out,
             db,
             img_format='png',
             title_sep=":",
-            value_sep=", "):
+            value_sep=", ",
+            where=None):
     
     # Remove xls or xlsx extension if added
     if out[-5:] == ".xlsx":
@@ -306,10 +312,9 @@ def dump_xl(out,
     required = _get_tree_attrs(schema.root_node, "required", False)
     ws.append(titles)
     
-    query = make_query(titles[0])
-    memdb = db.search(query)
+    query = make_query(titles[0], where=where)
     
-    for record in memdb.to_records().values():
+    for _, record in db.iter_records(query, view=True):
         
         row_values = [None] * len(titles)
         record_titles = _get_tree_titles(record, sep=title_sep)
@@ -367,7 +372,8 @@ def load_xl(db_path,
             strict=False,
             progress=False,
             title_sep=":",
-            value_sep=", "):
+            value_sep=", ",
+            journal=False):
     
     schema_titles = _get_tree_titles(schema, sep=title_sep)
     builder = FlatRecordBuilder(schema, title_sep, value_sep)
@@ -389,29 +395,20 @@ def load_xl(db_path,
         err_msg = (f"Invalid {noun} '{extra_titles_str}' found")
         raise ValueError(err_msg)
     
-    with JSONDataBase(db_path) as db:
-        
-        root_value_ids = get_root_value_ids(db)
-        
-        for values in ws.iter_rows(min_row=2, values_only=True):
-            
-            flat = {t: v for t, v in zip(titles, values)}
-            if flat['Title'] is None: continue
-            record = builder.build(flat, strict=strict)
-            root_value = record.root_node.value
-            
-            if root_value in root_value_ids:
-                doc_id = root_value_ids.pop(root_value)
-                db.replace(doc_id, record)
-                root_value_ids
-            else:
-                db.insert(record)
-            
-            if progress: print(".", end="", flush=True)
+    records = []
+    
+    for values in ws.iter_rows(min_row=2, values_only=True):
         
-        db.remove(root_value_ids.values())
+        flat = {t: v for t, v in zip(titles, values)}
+        if flat['Title'] is None: continue
+        records.append(builder.build(flat, strict=strict))
         
-        if progress: print("\n", end="", flush=True)
+        if progress: print(".", end="", flush=True)
+    
+    with open_database(db_path, journal=journal, schema=schema) as db:
+        db.upsert_many(records, remove_missing=True)
+    
+    if progress: print("\n", end="", flush=True)
 
 
 def dump_yaml(db, out=None):
@@ -440,9 +437,7 @@ def dump_yaml(db, out=None):
     outp = None
     if out: outp = Path(out)
     
-    records = db.to_records()
-    
-    for record in records.values():
+    for _, record in db.iter_records():
         export(record, outp)
 
 
@@ -468,8 +463,7 @@ def convert_child(child):
 
 def convert_record(record):
     
-    exporter = DictExporter()
-    exported = exporter.export(record.root_node)
+    exported = _export_node(record.root_node)
     result = {"Title": exported['value']}
     
     for child in exported['children']:
@@ -491,7 +485,8 @@ def render_tree(tree, path):
 
 def choice_count(path,
                  db,
-                 schema):
+                 schema,
+                 where=None):
     
     node = schema.find_by_path(path)
     
@@ -499,17 +494,23 @@ def choice_count(path,
     if (hasattr(node, "inquire") and
         getattr(node, "inquire") not in ["list", "checkbox"]): return
     
-    count = {child.name: db.count(make_query(get_node_path(child)))
+    selected = None
+    if where is not None: selected = make_query(where=where)
+    selected = db.bitmap(selected)
+    
+    count = {child.name: popcount(
+                    selected & db.bitmap(make_query(get_node_path(child))))
                                                  for child in node.children}
     
-    missing_count = db.count(~make_query(path))
+    missing_count = popcount(selected & ~db.bitmap(make_query(path)))
     if missing_count: count["None"] = missing_count
     
     return count
 
 
 def find_non_matching_records(records_one,
-                              records_two):
+                              records_two,
+                              workers=None):
     
     records_one_name_dict = {tree.root_node.value: tree
                                        for tree in records_one.values()}
@@ -522,24 +523,79 @@ def find_non_matching_records(records_one,
     matching = list(records_one_name_set & records_two_name_set)
     missing = list(records_one_name_set ^ records_two_name_set)
     
-    for name in matching:
-        if records_one_name_dict[name] == records_two_name_dict[name]:
-            continue
-        missing.append(name)
+    # Records with the same content hash are equal, so only the others
+    # are compared in full. Both paths compare the stored form of the
+    # records, so the result does not depend on the number of workers
+    changed = [name for name in matching
+                    if records_one_name_dict[name].get_hash() !=
+                                        records_two_name_dict[name].get_hash()]
+    pairs = ((name,
+              records_one_name_dict[name].to_dict(),
+              records_two_name_dict[name].to_dict()) for name in changed)
+    
+    if not is_parallel(len(changed), workers):
+        missing.extend(_find_non_matching_pairs(pairs))
+        return missing
+    
+    pairs = list(pairs)
+    chunks = [pairs[i:i + PARALLEL_CHUNK_SIZE]
+                        for i in range(0, len(pairs), PARALLEL_CHUNK_SIZE)]
+    
+    with ProcessPoolExecutor(workers) as executor:
+        for result in executor.map(_find_non_matching_pairs, chunks):
+            missing.extend(result)
     
     return missing
 
 
-def find_non_matching_nodes(db, schema):
+def find_non_matching_nodes(db, schema, where=None, workers=None):
     
-    result = {}
+    query = None
+    if where is not None: query = make_query(where=where)
     
-    for record in db.to_records().values():
-        added = [k for k, v in schema.diff(record).items() if v == 'added']
-        if not added: continue
-        result[record.root_node.value] = added
+    records = db.map_records(_AddedNodes(schema),
+                             query,
+                             workers)
     
-    return result
+    return dict(added for added in records.values() if added[1])
+
+
+class _AddedNodes:
+    
+    """Picklable record check that rebuilds the schema in each worker"""
+    
+    def __init__(self, schema):
+        self._schema = schema
+        self._schema_dict = None
+    
+    def __call__(self, record):
+        
+        if self._schema is None:
+            self._schema = SCHTree.from_dict(self._schema_dict)
+        
+        added = [k for k, v in self._schema.diff(record).items()
+                                                            if v == 'added']
+        
+        return (record.root_node.value, added)
+    
+    def __getstate__(self):
+        schema_dict = self._schema_dict
+        if schema_dict is None: schema_dict = self._schema.to_dict()
+        return {"_schema": None, "_schema_dict": schema_dict}
+
+
+def _find_non_matching_pairs(pairs):
+    return [name for name, one, two in pairs
+                                    if not RecordView(one) == RecordView(two)]
+
+
+def _export_node(node):
+    
+    exported = get_node_attr(node)
+    children = [_export_node(child) for child in node.children]
+    if children: exported["children"] = children
+    
+    return exported
 
 
 def _get_tree_titles(tree, sep=":"):
@@ -55,7 +55,7 @@ def compare_titles(page_titles, db, out="page", case_sensitive=False):
         caser = lambda x: x
     
     pages_titles_with_spaces = [x for x in page_titles if ' ' in x]
-    db_titles = [x['value'] for x in db.projection('Title')['Title']]
+    db_titles = db.keys()
     db_titles_case = [caser(x) for x in db_titles]
     
     matched_page = [x for x in page_titles if caser(x) in db_titles_case]
@@ -104,7 +104,7 @@ async def upload_records_to_site(db,
         matched, _ = compare_titles(names, db, out="db")
         skip += matched
     
-    for record in db.to_records().values():
+    for _, record in db.iter_records(view=True):
         
         title, fields = title_and_fields_from_record(record)
         
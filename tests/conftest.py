@@ -0,0 +1,25 @@
+import pytest
+
+from taxonopy.schema import SCHTree
+
+
+def _make_record(name, colour, features=None):
+    
+    record = SCHTree()
+    record.add_node("Name", type="str", value=name)
+    record.add_node("Colour", "Name", inquire="list")
+    record.add_node(colour, "Name/Colour")
+    
+    if features is None: return record
+    
+    record.add_node("Features", "Name", inquire="checkbox")
+    
+    for feature in features:
+        record.add_node(feature, "Name/Features")
+    
+    return record
+
+
+@pytest.fixture
+def make_record():
+    return _make_record
@@ -1,7 +1,29 @@
 
+import os
+import json
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from taxonopy.db import _order_data
+import pytest
+from anytree import PreOrderIter
+from anytree.resolver import ChildResolverError
+from tinydb import Query
+from tinydb.storages import MemoryStorage
+
+from taxonopy.codec import get_codec
+from taxonopy.db import (ConflictError,
+                         JSONDataBase,
+                         MemoryDataBase,
+                         SQLiteDataBase,
+                         WriteSortMiddleware,
+                         _order_data,
+                         convert_database,
+                         get_journal_path,
+                         make_query,
+                         open_database)
+from taxonopy.index import KeyIndex, iter_bits, popcount, to_bitmap
+from taxonopy.query import IdQuery
+from taxonopy.schema import CompactNode, RecordView, SCHTree, get_node_path
 
 
 def test_order_data():
@@ -56,3 +78,1019 @@ def test_order_data():
     ordered = _order_data(test)
     
     assert OrderedDict(ordered) == OrderedDict(expected)
+
+
+def test_record_view(make_record):
+    
+    record = make_record("One", "Blue", ["Defrost", "Reheat"])
+    view = RecordView(record.to_dict())
+    
+    assert view.root_node.name == "Name"
+    assert view.root_node.value == "One"
+    assert [child.name for child in view.root_node.children] == \
+                                                    ["Colour", "Features"]
+    
+    node = view.find_by_path("/Name/Features/Reheat")
+    
+    assert get_node_path(node) == "/Name/Features/Reheat"
+    assert node.parent.inquire == "checkbox"
+    assert node.depth == 2
+    assert not hasattr(node, "value")
+    
+    with pytest.raises(ChildResolverError):
+        view.find_by_path("Name/Colour/Black")
+    
+    assert view == RecordView(record.to_dict())
+    assert view != RecordView(make_record("One", "Black").to_dict())
+    
+    db = MemoryDataBase()
+    doc_id = db.insert(record)
+    
+    assert list(db.to_views()) == [doc_id]
+    assert isinstance(db.to_records()[doc_id].root_node, CompactNode)
+    assert db.projection("Name/Features")["Name/Features"] == \
+                                        [{"children": ["Defrost", "Reheat"],
+                                          "inquire": "checkbox",
+                                          "name": "Features"}]
+
+
+def test_sort_index_order(make_record):
+    
+    db = MemoryDataBase()
+    two = db.insert(make_record("two", "Blue"))
+    one = db.insert(make_record("One", "Blue"))
+    three = db.insert(make_record("Three", "Blue"))
+    
+    assert list(db.to_views()) == [one, three, two]
+    
+    db.replace(one, make_record("zero", "Blue"))
+    four = db.insert(make_record("Four", "Black"))
+    db.remove([three])
+    
+    assert list(db.to_views()) == [four, two, one]
+    assert list(db.to_records()) == [four, two, one]
+    assert db.projection()["id"] == [four, two, one]
+
+
+def test_path_index_insert_remove_replace(make_record):
+    
+    db = MemoryDataBase()
+    one = db.insert(make_record("One", "Blue", ["Defrost"]))
+    two = db.insert(make_record("Two", "Black"))
+    
+    assert db.count(make_query("Name/Colour/Blue")) == 1
+    assert db.count(make_query("/Name/Features")) == 1
+    assert db.count(make_query("Name")) == 2
+    
+    db.replace(two, make_record("Two", "Blue", ["Reheat"]))
+    
+    assert db.count(make_query("Name/Colour/Blue")) == 2
+    assert db.count(make_query("Name/Colour/Black")) == 0
+    assert db.count(make_query("Name/Features")) == 2
+    
+    db.remove([one])
+    
+    assert db.count(make_query("Name/Colour/Blue")) == 1
+    assert db.count(make_query("Name/Features/Defrost")) == 0
+    assert list(db.search(make_query("Name/Colour/Blue")).to_records()) == \
+                                                                        [two]
+
+
+def test_path_index_value_query(make_record):
+    
+    db = MemoryDataBase()
+    db.insert(make_record("Beko One", "Blue"))
+    db.insert(make_record("Beko", "Black"))
+    
+    assert db.count(make_query("Name", "Beko")) == 2
+    assert db.count(make_query("Name", "Beko", exact=True)) == 1
+    assert db.count(make_query("Name/Colour", "Beko")) == 0
+
+
+def test_value_index_substring_and_exact(make_record):
+    
+    db = MemoryDataBase()
+    one = db.insert(make_record("BEKO Cosmopolis", "Blue"))
+    two = db.insert(make_record("Beko Toaster", "Black"))
+    
+    assert db.count(make_query("Name", "Beko")) == 1
+    assert db.count(make_query("Name", "o")) == 2
+    assert db.count(make_query("Name", "Toaster Beko")) == 0
+    assert db.count(make_query("Name", "Beko Toaster", exact=True)) == 1
+    
+    db.replace(two, make_record("BEKO Toaster", "Black"))
+    
+    assert db.count(make_query("Name", "Beko")) == 0
+    assert db.count(make_query("Name", "BEKO")) == 2
+    
+    db.remove([one])
+    
+    assert db.count(make_query("Name", "BEKO")) == 1
+    assert db.count(make_query("Name", "Cosmo")) == 0
+
+
+def test_journal_append_and_compact(tmp_path, make_record):
+    
+    db_path = str(tmp_path / "db.json")
+    journal_path = get_journal_path(db_path)
+    
+    with JSONDataBase(db_path) as db:
+        db.insert(make_record("One", "Blue"))
+    
+    canonical = (tmp_path / "db.json").read_text()
+    
+    with JSONDataBase(db_path, journal=True) as db:
+        two = db.insert(make_record("Two", "Black"))
+        db.replace(1, make_record("One", "Brown"))
+    
+    assert (tmp_path / "db.json").read_text() == canonical
+    
+    with open(journal_path) as f:
+        entries = [json.loads(line) for line in f]
+    
+    ops = [entry["op"] for entry in entries if entry["table"] == "_default"]
+    
+    assert sorted(ops) == ["insert", "replace"]
+    
+    with JSONDataBase(db_path, journal=True) as db:
+        db.remove([two])
+    
+    with JSONDataBase(db_path) as db:
+        assert len(db) == 1
+        assert db.count(make_query("Name/Colour/Brown")) == 1
+        db.compact()
+    
+    assert not os.path.isfile(journal_path)
+    
+    with JSONDataBase(db_path) as db:
+        records = db.to_records()
+    
+    assert list(records) == [1]
+    assert records[1] == make_record("One", "Brown")
+
+
+def test_concurrent_json_writers(tmp_path, make_record):
+    
+    db_path = str(tmp_path / "db.json")
+    
+    with JSONDataBase(db_path) as db:
+        one = db.insert(make_record("One", "Blue"))
+        two = db.insert(make_record("Two", "Blue"))
+    
+    first = JSONDataBase(db_path)
+    second = JSONDataBase(db_path)
+    
+    assert first.get_version(one) == second.get_version(one) == 1
+    
+    # Edits to different records are merged rather than overwritten
+    first.replace(one, make_record("One", "Black"))
+    second.replace(two, make_record("Two", "Brown"))
+    first.close()
+    second.close()
+    
+    with JSONDataBase(db_path) as db:
+        assert db.get_version(one) == db.get_version(two) == 2
+        assert db.search_ids(make_query("Name/Colour/Black")) == [one]
+        assert db.search_ids(make_query("Name/Colour/Brown")) == [two]
+    
+    first = JSONDataBase(db_path)
+    second = JSONDataBase(db_path)
+    
+    # Both sessions read the records before either of them writes
+    assert len(first) == len(second) == 2
+    
+    first.replace(one, make_record("One", "Blue"))
+    first.close()
+    second.replace(one, make_record("One", "Green"))
+    
+    with pytest.raises(ConflictError):
+        second.close()
+    
+    with JSONDataBase(db_path) as db:
+        assert db.get_version(one) == 3
+        assert db.search_ids(make_query("Name/Colour/Blue")) == [one]
+        assert len(db) == 2
+    
+    first = JSONDataBase(db_path)
+    second = JSONDataBase(db_path)
+    assert len(first) == len(second) == 2
+    
+    # Records inserted by both sessions are kept under different ids
+    three = first.insert(make_record("Three", "Red"))
+    four = second.insert(make_record("Four", "Red"))
+    assert three == four
+    first.close()
+    second.compact()
+    
+    assert second.search_ids(make_query("Name", "Three")) == [three]
+    four = second.search_ids(make_query("Name", "Four"))[0]
+    assert four != three
+    
+    five = second.insert(make_record("Five", "Red"))
+    assert five not in (one, two, three, four)
+    second.close()
+    
+    with JSONDataBase(db_path) as db:
+        assert len(db) == 5
+        assert db.search_ids(make_query("Name/Colour/Red")) == sorted(
+                                                        [three, four, five])
+
+
+def test_concurrent_json_writers_same_size(tmp_path, make_record):
+    
+    db_path = tmp_path / "db.json"
+    
+    with JSONDataBase(str(db_path)) as db:
+        one = db.insert(make_record("One", "Blue"))
+        two = db.insert(make_record("Two", "Blue"))
+    
+    first = JSONDataBase(str(db_path))
+    assert len(first) == 2
+    
+    # Another process changes the file without changing its size or
+    # modification time
+    stat = os.stat(db_path)
+    text = db_path.read_text()
+    changed = text.replace('"Blue"', '"Pink"')
+    assert changed != text and len(changed) == len(text)
+    
+    db_path.write_text(changed)
+    os.utime(db_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    
+    with JSONDataBase(str(db_path)) as db:
+        assert db.search_ids(make_query("Name/Colour/Pink")) == [one, two]
+    
+    # The change is merged rather than overwritten
+    first.replace(one, make_record("One", "Black"))
+    first.close()
+    
+    with JSONDataBase(str(db_path)) as db:
+        assert db.search_ids(make_query("Name/Colour/Black")) == [one]
+        assert db.search_ids(make_query("Name/Colour/Pink")) == [two]
+
+
+def test_json_reader_leaves_no_lock(tmp_path, make_record):
+    
+    db_path = str(tmp_path / "db.json")
+    
+    with JSONDataBase(db_path) as db:
+        db.insert(make_record("One", "Blue"))
+    
+    os.remove(db_path + ".lock")
+    
+    with JSONDataBase(db_path) as db:
+        assert len(db) == 1
+    
+    assert not os.path.exists(db_path + ".lock")
+
+
+def test_sqlite_database_matches_json(tmp_path, make_record):
+    
+    json_path = str(tmp_path / "db.json")
+    sqlite_path = str(tmp_path / "db.sqlite")
+    
+    with JSONDataBase(json_path) as db:
+        db.insert(make_record("Two", "Blue", ["Defrost"]))
+        db.insert(make_record("one", "Black", ["Defrost", "Reheat"]))
+        db.insert(make_record("Three", "Blue"))
+    
+    convert_database(json_path, sqlite_path)
+    
+    with open_database(json_path) as json_db:
+        with open_database(sqlite_path) as sqlite_db:
+            
+            assert isinstance(sqlite_db, SQLiteDataBase)
+            assert len(sqlite_db) == 3
+            
+            json_records = json_db.to_records()
+            sqlite_records = sqlite_db.to_records()
+            
+            assert list(sqlite_records) == list(json_records)
+            assert list(sqlite_records.values()) == \
+                                                list(json_records.values())
+            
+            for query in [make_query("Name/Colour/Blue"),
+                          make_query("Name/Features/Reheat"),
+                          make_query("Name", "T"),
+                          make_query("Name", "one", exact=True)]:
+                assert sqlite_db.count(query) == json_db.count(query)
+            
+            paths = [None, "Name/Features", "Name/Colour"]
+            assert sqlite_db.projection(paths) == json_db.projection(paths)
+
+
+def test_iter_records(tmp_path, make_record):
+    
+    json_path = str(tmp_path / "db.json")
+    sqlite_path = str(tmp_path / "db.sqlite")
+    
+    with JSONDataBase(json_path) as db:
+        db.insert(make_record("Two", "Blue", ["Defrost"]))
+        db.insert(make_record("one", "Black", ["Defrost", "Reheat"]))
+        db.insert(make_record("Three", "Blue"))
+    
+    convert_database(json_path, sqlite_path)
+    
+    for db_path in (json_path, sqlite_path):
+        
+        with open_database(db_path) as db:
+            
+            expected = db.to_records()
+            records = db.iter_records(chunk_size=2)
+            
+            assert next(records) == next(iter(expected.items()))
+            assert list(dict(records)) == list(expected)[1:]
+            
+            query = make_query("Name/Colour/Blue")
+            views = dict(db.iter_records(query, view=True))
+            
+            assert [view.root_node.value for view in views.values()] == \
+                                                            ["Three", "Two"]
+            
+            pruned = dict(db.iter_records(paths="Name/Features"))
+            names = [[node.name for node in PreOrderIter(record.root_node)]
+                                                for record in pruned.values()]
+            
+            assert names == [["Name", "Features", "Defrost", "Reheat"],
+                             ["Name"],
+                             ["Name", "Features", "Defrost"]]
+
+
+def test_select_where(tmp_path, make_record):
+    
+    json_path = str(tmp_path / "db.json")
+    sqlite_path = str(tmp_path / "db.sqlite")
+    
+    with JSONDataBase(json_path) as db:
+        
+        one = make_record("One", "Blue", ["Defrost"])
+        one.add_node("Capacity", "Name", type="int", value=4)
+        db.insert(one)
+        
+        two = make_record("Two", "Blue", ["Reheat"])
+        two.add_node("Capacity", "Name", type="int", value="12")
+        db.insert(two)
+        
+        three = make_record("Three", "Black")
+        three.add_node("Toast & Bake (2 > 1)", "Name")
+        db.insert(three)
+    
+    convert_database(json_path, sqlite_path)
+    
+    tests = [("Name/Colour/Blue & !Name/Features/Defrost", ["Two"]),
+             ("Name/Colour/Blue & Name/Capacity>=4", ["One", "Two"]),
+             ("Name/Capacity > 4 | Name/Colour/Black", ["Three", "Two"]),
+             ("!(Name/Colour/Blue) & Name = 'Three'", ["Three"]),
+             ("Name ~ T & !Name/Features", ["Three"]),
+             ("Name != One", ["Three", "Two"]),
+             ("'Name/Toast & Bake (2 > 1)'", ["Three"]),
+             ("!\"Name/Toast & Bake (2 > 1)\" & Name/Colour", ["One", "Two"])]
+    
+    for db_path in (json_path, sqlite_path):
+        
+        with open_database(db_path) as db:
+            
+            for where, expected in tests:
+                
+                result = db.select(where)
+                values = sorted(record.root_node.value
+                                    for record in result.to_records().values())
+                
+                assert values == expected
+                assert db.count(make_query(where=where)) == len(expected)
+                
+                # The per document test must agree with the indexes
+                query = make_query(where=where)
+                assert sorted(doc_id for doc_id, doc in db._iter_documents()
+                                                if query(doc)) == \
+                                            sorted(db._search_ids(query))
+    
+    for where in ["Name &", "(Name", "Name = ", "Name/Colour | | Name",
+                  "'Name/Toast & Bake"]:
+        with pytest.raises(ValueError):
+            make_query(where=where)
+
+
+@pytest.mark.parametrize("db_name", ["db.json", "db.sqlite"])
+def test_query_cache_invalidation(tmp_path, db_name, make_record):
+    
+    with open_database(str(tmp_path / db_name)) as db:
+        
+        one = db.insert(make_record("One", "Blue", ["Defrost"]))
+        two = db.insert(make_record("Two", "Black"))
+        
+        blue = make_query("Name/Colour/Blue")
+        no_defrost = make_query(where="!Name/Features/Defrost")
+        
+        assert db.search_ids(blue) == [one]
+        assert db.search_ids(no_defrost) == [two]
+        assert len(db._query_cache) == 2
+        
+        three = db.insert(make_record("Three", "Blue"))
+        db.replace(one, make_record("One", "Black", ["Defrost"]))
+        
+        assert db._query_cache.get(blue) == {three}
+        assert db.search_ids(blue) == [three]
+        assert db.search_ids(no_defrost) == [two, three]
+        
+        db.remove([two])
+        
+        assert db.count(no_defrost) == 1
+        assert db.count(make_query("/Name/Colour/Blue")) == 1
+        assert len(db._query_cache) == 2
+
+
+@pytest.mark.parametrize("db_name", ["db.json", "db.sqlite"])
+def test_upsert_many(tmp_path, monkeypatch, db_name, make_record):
+    
+    db_path = str(tmp_path / db_name)
+    
+    # Read the replaced records in several chunks
+    monkeypatch.setattr("taxonopy.db.READ_CHUNK_SIZE", 1)
+    
+    with open_database(db_path) as db:
+        one = db.insert(make_record("One", "Blue"))
+        two = db.insert(make_record("Two", "Black"))
+        three = db.insert(make_record("Three", "Blue"))
+        blue = make_query("Name/Colour/Blue")
+        assert db.search_ids(blue) == [one, three]
+    
+    records = [make_record("Two", "Black"),
+               make_record("One", "Black"),
+               make_record("Four", "Blue"),
+               make_record("Four", "Black")]
+    
+    with open_database(db_path) as db:
+        
+        result = db.upsert_many(records)
+        four = result["inserted"][0]
+        
+        assert result == {"inserted": [four],
+                          "replaced": [one],
+                          "unchanged": [two],
+                          "removed": []}
+        assert len(db) == 4
+        assert db.search_ids(make_query("Name/Colour/Blue")) == [three]
+        
+        result = db.upsert_many(records[:2], remove_missing=True)
+        
+        assert result["removed"] == [three, four]
+        assert result["unchanged"] == [one, two]
+    
+    with open_database(db_path) as db:
+        records = db.to_records()
+        assert list(records) == [one, two]
+        assert records[one].find_by_path("Name/Colour/Black")
+    
+    unnamed = SCHTree()
+    unnamed.add_node("Name")
+    
+    with open_database(db_path) as db:
+        
+        with pytest.raises(ValueError):
+            db.upsert_many(records.values(), key="name")
+        
+        with pytest.raises(ValueError):
+            db.upsert_many([*records.values(), unnamed])
+        
+        assert len(db) == 2
+
+
+@pytest.mark.parametrize("db_name", ["db.json", "db.sqlite"])
+def test_key_index(tmp_path, db_name, make_record):
+    
+    db_path = str(tmp_path / db_name)
+    
+    with open_database(db_path) as db:
+        one = db.insert(make_record("One", "Blue"))
+        two = db.insert(make_record("Two", "Black"))
+    
+    with open_database(db_path) as db:
+        
+        assert db.get_by_key("One") == one
+        assert db.has_key("Two")
+        assert not db.has_key("Three")
+        assert sorted(db.keys()) == ["One", "Two"]
+        
+        with pytest.raises(ValueError):
+            db.insert(make_record("One", "Black"))
+        
+        with pytest.raises(ValueError):
+            db.replace(two, make_record("One", "Black"))
+        
+        db.replace(one, make_record("Three", "Blue"))
+        db.remove([two])
+        four = db.insert(make_record("Two", "Blue"))
+        
+        assert db.get_by_key("One") is None
+        assert db.get_by_key("Three") == one
+        assert db.get_by_key("Two") == four
+        assert len(db) == 2
+
+
+def test_sqlite_keys_without_index(tmp_path, make_record):
+    
+    db_path = str(tmp_path / "db.sqlite")
+    
+    with open_database(db_path) as db:
+        one = db.insert(make_record("One", "Blue"))
+        db.insert(make_record("Two", "Black"))
+    
+    # Keys are looked up in the stored root values, so the key index is
+    # not built when records are added
+    with open_database(db_path) as db:
+        
+        assert db.get_by_key("One") == one
+        assert not db.has_key("Three")
+        
+        three = db.insert(make_record("Three", "Blue"))
+        result = db.upsert_many([make_record("One", "Black"),
+                                 make_record("Four", "Blue")])
+        
+        assert db.get_by_key("Three") == three
+        assert result["replaced"] == [one]
+        assert KeyIndex not in db._indexes
+        
+        with pytest.raises(ValueError):
+            db.insert(make_record("Four", "Black"))
+        
+        assert KeyIndex not in db._indexes
+        assert sorted(db.keys()) == ["Four", "One", "Three", "Two"]
+
+
+@pytest.mark.parametrize("db_name", ["db.json", "db.sqlite"])
+def test_key_index_existing_duplicates(tmp_path, db_name, make_record):
+    
+    json_path = tmp_path / "duplicates.json"
+    docs = {str(i): make_record("One", colour).to_dict()
+                        for i, colour in enumerate(["Blue", "Black"], 1)}
+    json_path.write_text(json.dumps({"_default": docs}))
+    
+    db_path = str(tmp_path / db_name)
+    convert_database(str(json_path), db_path)
+    
+    # Records that already share a key can still be read and replaced
+    with open_database(db_path) as db:
+        
+        assert db.keys() == ["One"]
+        assert db.get_by_key("One") == 1
+        
+        db.replace(2, make_record("One", "Green"))
+        two = db.insert(make_record("Two", "Blue"))
+        
+        with pytest.raises(ValueError):
+            db.insert(make_record("One", "Brown"))
+        
+        with pytest.raises(ValueError):
+            db.replace(two, make_record("One", "Brown"))
+        
+        db.remove([1])
+        assert db.get_by_key("One") == 2
+    
+    with open_database(db_path) as db:
+        assert sorted(db.keys()) == ["One", "Two"]
+        assert db.search_ids(make_query("Name/Colour/Green")) == [2]
+
+
+@pytest.mark.parametrize("db_name", ["db.json", "db.sqlite"])
+def test_search_result(tmp_path, db_name, make_record):
+    
+    with open_database(str(tmp_path / db_name)) as db:
+        
+        zero = db.insert(make_record("Zero", "Black"))
+        two = db.insert(make_record("Two", "Blue", ["Defrost"]))
+        one = db.insert(make_record("One", "Blue"))
+        
+        result = db.search(make_query("Name/Colour/Blue"))
+        
+        assert len(result) == 2
+        assert list(result) == [one, two]
+        assert list(result.to_records()) == [one, two]
+        assert result.count(make_query("Name/Features")) == 1
+        assert result.projection()["id"] == [one, two]
+        assert result.projection("Name/Features")["Name/Features"] == \
+                [{}, {"children": ["Defrost"],
+                      "inquire": "checkbox",
+                      "name": "Features"}]
+        
+        chained = result.search(make_query("Name/Features/Defrost"))
+        
+        assert list(chained.to_views()) == [two]
+        assert list(result.select("Name ~ O").to_views()) == [one]
+        assert one in result and one not in chained
+        assert len(db._query_cache) == 4
+        
+        # Fixed sets of records can be combined with other queries
+        ids = IdQuery([one, two])
+        
+        assert db.search_ids(ids & Query().L0.exists()) == sorted([one, two])
+        assert db.search_ids(~ids & make_query("Name/Colour")) == [zero]
+        assert ids._match({}, one) and not ids._match({}, None)
+        
+        # Record reading paths test the document ids in the same way
+        combined = ids & Query().L0.exists()
+        
+        assert [doc_id for doc_id, _ in db.iter_records(combined)] == \
+                                    [one, two]
+        assert list(db.map_records(str, combined)) == [one, two]
+        assert db.projection("Name", combined)["id"] == [one, two]
+        assert list(db.iter_records(~ids & Query().L0.exists())) == \
+                                    [(zero, db.to_records()[zero])]
+
+
+@pytest.mark.parametrize("db_name", ["db.json", "db.sqlite"])
+def test_snapshot(tmp_path, db_name, make_record):
+    
+    with open_database(str(tmp_path / db_name)) as db:
+        
+        one = db.insert(make_record("One", "Blue"))
+        two = db.insert(make_record("Two", "Blue"))
+        snapshot = db.snapshot()
+        
+        db.replace(one, make_record("One", "Black"))
+        db.remove([two])
+        db.insert(make_record("Three", "Blue"))
+        
+        with ThreadPoolExecutor(1) as executor:
+            future = executor.submit(snapshot.projection)
+            db.insert(make_record("Four", "Blue"))
+        
+        assert future.result()["id"] == [one, two]
+        assert snapshot.search_ids(make_query("Name/Colour/Blue")) == \
+                                                                    [one, two]
+        assert len(db) == 3
+        
+        with pytest.raises(IOError):
+            snapshot.insert(make_record("Five", "Blue"))
+        
+        assert len(snapshot) == 2
+        assert len(snapshot.snapshot()) == 2
+
+
+@pytest.mark.parametrize("db_name", ["db.json", "db.sqlite"])
+def test_bitmap_choice_index(tmp_path, db_name, make_record):
+    
+    with open_database(str(tmp_path / db_name)) as db:
+        
+        one = db.insert(make_record("One", "Blue", ["Defrost"]))
+        two = db.insert(make_record("Two", "Black", ["Defrost", "Reheat"]))
+        three = db.insert(make_record("Three", "Blue"))
+        
+        blue = db.bitmap(make_query("Name/Colour/Blue"))
+        defrost = db.bitmap(make_query("Name/Features/Defrost"))
+        
+        assert list(iter_bits(blue)) == [one, three]
+        assert popcount(blue & defrost) == 1
+        assert list(iter_bits(db.bitmap() & ~defrost)) == [three]
+        
+        where = make_query(where="Name/Colour/Blue | !Name/Features/Reheat")
+        assert list(iter_bits(db.bitmap(where))) == db.search_ids(where)
+        
+        db.replace(three, make_record("Three", "Black", ["Defrost"]))
+        db.remove([one])
+        
+        assert db.bitmap(make_query("Name/Colour/Blue")) == 0
+        assert list(iter_bits(db.bitmap(make_query("Name/Features")))) == \
+                                                                [two, three]
+        assert to_bitmap([two, three]) == \
+                                db.bitmap(make_query("Name/Colour/Black"))
+
+
+@pytest.mark.parametrize("codec", ["json", "orjson", "ujson"])
+def test_codec_storage(tmp_path, codec, make_record):
+    
+    try:
+        get_codec(codec)
+    except ValueError:
+        pytest.skip(f"{codec} is not installed")
+    
+    db_path = str(tmp_path / "db.json")
+    
+    with open_database(db_path, codec=codec) as db:
+        one = db.insert(make_record("Öne", "Blue", ["Defrost"]))
+    
+    with open(db_path, encoding="utf-8") as f:
+        assert "\n" not in f.read()
+    
+    with open_database(db_path, codec=codec, pretty=True) as db:
+        record = db.to_records()[one]
+        assert record.root_node.value == "Öne"
+        db.flush()
+    
+    with open(db_path, encoding="utf-8") as f:
+        text = f.read()
+    
+    assert text == json.dumps(json.loads(text), indent=4)
+    assert SCHTree.from_json(record.to_json()).to_dict() == record.to_dict()
+
+
+def test_sharded_database(tmp_path, monkeypatch, make_record):
+    
+    db_path = str(tmp_path / "shards") + "/"
+    names = [f"Record {i}" for i in range(20)]
+    
+    with open_database(db_path, shards=4) as db:
+        for name in names:
+            db.insert(make_record(name, "Blue"))
+    
+    def read_shards():
+        return {path.name: path.read_text()
+                            for path in (tmp_path / "shards").glob("shard-*")}
+    
+    shards = read_shards()
+    assert len(shards) == 4
+    
+    with open_database(db_path) as db:
+        
+        doc_id = db.get_by_key("Record 3")
+        
+        assert db.has_key("Record 3")
+        assert not db.has_key("Record 30")
+        assert db._db.storage.cache is None
+        
+        db.replace(doc_id, make_record("Record 3", "Black"))
+    
+    changed = [name for name, text in read_shards().items()
+                                                    if text != shards[name]]
+    assert len(changed) == 1
+    
+    # Force the full scan to parse the shards in a process pool
+    monkeypatch.setattr("taxonopy.db.PARALLEL_READ_SIZE", 0)
+    
+    with open_database(db_path, workers=2) as db:
+        assert sorted(db.keys()) == sorted(names)
+        assert db.search_ids(make_query("Name/Colour/Black")) == [doc_id]
+    
+    with pytest.raises(ValueError):
+        open_database(db_path, shards=8)
+
+
+def test_concurrent_sharded_writers(tmp_path, make_record):
+    
+    db_path = str(tmp_path / "shards") + "/"
+    
+    with open_database(db_path, shards=4) as db:
+        one = db.insert(make_record("One", "Blue"))
+    
+    first = open_database(db_path)
+    second = open_database(db_path)
+    assert len(first) == len(second) == 1
+    
+    # Records inserted by both sessions are kept under different ids
+    two = first.insert(make_record("Two", "Red"))
+    three = second.insert(make_record("Three", "Red"))
+    assert two == three
+    first.close()
+    second.close()
+    
+    with open_database(db_path) as db:
+        assert sorted(db.keys()) == ["One", "Three", "Two"]
+        assert len(set(db.search_ids(make_query("Name/Colour/Red")))) == 2
+        assert db.get_version(one) == 1
+    
+    first = open_database(db_path)
+    second = open_database(db_path)
+    assert len(first) == len(second) == 3
+    
+    first.replace(one, make_record("One", "Black"))
+    first.close()
+    second.replace(one, make_record("One", "Green"))
+    
+    with pytest.raises(ConflictError):
+        second.close()
+    
+    with open_database(db_path) as db:
+        assert db.get_version(one) == 2
+        assert db.search_ids(make_query("Name/Colour/Black")) == [one]
+
+
+def test_non_matching_records_hashes(tmp_path, monkeypatch, make_record):
+    
+    import taxonopy.utils
+    from taxonopy.utils import find_non_matching_records
+    
+    db_path = str(tmp_path / "db.json")
+    
+    with open_database(db_path) as db:
+        for i in range(4):
+            db.insert(make_record(f"Record {i}", "Blue"))
+        views = db.to_views()
+        other = db.to_views()
+    
+    other[2] = RecordView(make_record("Record 1", "Black").to_dict())
+    compared = []
+    
+    def find_pairs(pairs):
+        pairs = list(pairs)
+        compared.extend(name for name, _, _ in pairs)
+        return find_non_matching_pairs(pairs)
+    
+    # Only records with different hashes are compared in full
+    find_non_matching_pairs = taxonopy.utils._find_non_matching_pairs
+    monkeypatch.setattr(taxonopy.utils, "_find_non_matching_pairs", find_pairs)
+    
+    assert find_non_matching_records(views, other) == ["Record 1"]
+    assert compared == ["Record 1"]
+
+
+@pytest.mark.parametrize("db_ext", [".json", ".sqlite"])
+def test_parallel_records(tmp_path, monkeypatch, db_ext, make_record):
+    
+    from taxonopy.utils import (find_non_matching_nodes,
+                                find_non_matching_records)
+    
+    schema = make_record("Schema", "Blue", ["Defrost"])
+    schema.add_node("Black", "Name/Colour")
+    
+    db_path = str(tmp_path / f"db{db_ext}")
+    
+    with open_database(db_path) as db:
+        for i in range(6):
+            features = ["Reheat"] if i % 2 else None
+            db.insert(make_record(f"Record {i}", "Blue", features))
+        serial_records = db.to_records(workers=1)
+        serial_nodes = find_non_matching_nodes(db, schema, workers=1)
+    
+    # Force the process pool for a small database
+    monkeypatch.setattr("taxonopy.db.PARALLEL_MIN_RECORDS", 0)
+    
+    with open_database(db_path) as db:
+        
+        # Without workers, records are still built in this process
+        with monkeypatch.context() as m:
+            m.setattr("taxonopy.db.ProcessPoolExecutor", None)
+            default_records = db.to_records()
+        
+        records = db.to_records(workers=2)
+        names = db.map_records(lambda record: record.root_node.value,
+                               workers=1,
+                               view=True)
+        nodes = find_non_matching_nodes(db, schema, workers=2)
+        
+        views = db.to_views()
+        other = db.to_views()
+        other[1] = RecordView(make_record("Record 0", "Black").to_dict())
+        missing = find_non_matching_records(views, other, workers=2)
+        
+        # Both paths compare records in the same way, whichever form they
+        # are given in
+        trees = db.to_records()
+        other_trees = {doc_id: SCHTree.from_dict(view.to_dict())
+                                            for doc_id, view in other.items()}
+        other_trees[2].update_node("Name/Colour", inquire="checkbox")
+        reordered = make_record("Record 3", "Blue", ["Reheat"])
+        reordered.move_node("Name/Colour", "Name")
+        other_trees[4] = reordered
+        
+        results = [find_non_matching_records(one, two, workers)
+                            for one, two in [(views, other),
+                                             (trees, other_trees)]
+                                for workers in [1, 2]]
+    
+    assert list(records) == list(serial_records) == list(default_records)
+    assert [record.to_dict() for record in records.values()] == \
+                [record.to_dict() for record in serial_records.values()]
+    assert records == serial_records == default_records
+    assert list(names.values()) == [records[doc_id].root_node.value
+                                                    for doc_id in records]
+    assert nodes == serial_nodes
+    assert sorted(nodes) == ["Record 1", "Record 3", "Record 5"]
+    assert missing == ["Record 0"]
+    assert [sorted(result) for result in results] == \
+                    [["Record 0"]] * 2 + [["Record 0", "Record 1"]] * 2
+
+
+def test_sqlite_database_round_trip(tmp_path, make_record):
+    
+    json_path = str(tmp_path / "db.json")
+    sqlite_path = str(tmp_path / "db.sqlite")
+    copy_path = str(tmp_path / "copy.json")
+    
+    with JSONDataBase(json_path) as db:
+        db.insert(make_record("One", "Blue", ["Defrost"]))
+        db.insert(make_record("Two", "Black"))
+    
+    convert_database(json_path, sqlite_path)
+    
+    with SQLiteDataBase(sqlite_path) as db:
+        db.insert(make_record("Three", "Brown"))
+        db.remove([1])
+    
+    with pytest.raises(ValueError):
+        convert_database(json_path, sqlite_path)
+    
+    convert_database(sqlite_path, copy_path)
+    
+    with JSONDataBase(copy_path) as db:
+        records = db.to_records()
+    
+    assert list(records) == [3, 2]
+    assert records[2] == make_record("Two", "Black")
+    assert records[3] == make_record("Three", "Brown")
+
+
+def test_write_sort_middleware_orders_changed_documents(make_record):
+    
+    docs = {str(i): make_record(f"Name {i}", "Blue", ["Reheat", "Defrost"]
+                                                            ).to_dict()
+                                                    for i in range(1, 12)}
+    data = {"_default": docs}
+    
+    middleware = WriteSortMiddleware(MemoryStorage)()
+    middleware.write(data)
+    
+    assert list(middleware.storage.memory["_default"]) == \
+                                            [str(i) for i in range(1, 12)]
+    assert middleware.storage.memory == _order_data(data)
+    
+    docs["12"] = make_record("New", "Black", ["Defrost"]).to_dict()
+    docs["3"] = make_record("Replaced", "Brown").to_dict()
+    del docs["10"]
+    middleware.write(data)
+    
+    assert middleware.storage.memory == _order_data(data)
+    assert list(middleware.storage.memory["_default"]) == \
+                        [str(i) for i in range(1, 13) if i != 10]
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_flush_orders_stored_documents(tmp_path, sharded, make_record):
+    
+    docs = {str(i): make_record(f"Name {i}", "Blue", ["Reheat", "Defrost"]
+                                                            ).to_dict()
+                                                    for i in [10, 2, 1]}
+    
+    for doc in docs.values():
+        for nodes in doc.values(): nodes.reverse()
+    
+    # The unordered documents are stored without the middleware
+    if sharded:
+        db_path = str(tmp_path / "shards") + "/"
+        open_database(db_path, shards=1).close()
+        path = tmp_path / "shards" / "shard-000.json"
+    else:
+        db_path = str(tmp_path / "db.json")
+        path = tmp_path / "db.json"
+    
+    data = {"_default": docs}
+    path.write_text(json.dumps(data))
+    
+    with open_database(db_path) as db:
+        db.flush()
+    
+    stored = json.loads(path.read_text())
+    
+    assert stored == _order_data(data)
+    assert list(stored["_default"]) == ["1", "2", "10"]
+    assert stored["_default"]["1"]["L2"][0]["name"] == "Blue"
+
+
+def test_schema_referenced_storage(tmp_path, make_record):
+    
+    schema = SCHTree()
+    schema.add_node("Name", type="str", required="True")
+    schema.add_node("Colour", "Name", inquire="list", description="Colour")
+    schema.add_node("Blue", "Name/Colour")
+    schema.add_node("Black", "Name/Colour")
+    
+    record = SCHTree()
+    record.add_node("Name", type="str", value="One")
+    record.add_node("Colour", "Name", inquire="list", description="Changed")
+    record.add_node("Blue", "Name/Colour")
+    other = make_record("Two", "Black")
+    other.add_node("Extra", "Name", value="x")
+    
+    db_path = tmp_path / "db.json"
+    
+    with JSONDataBase(str(db_path), schema=schema, referenced=True) as db:
+        db.insert(record)
+        db.insert(other)
+    
+    data = json.loads(db_path.read_text())
+    stored = data["_default"]["1"]
+    
+    assert set(data["_schemas"]) == {stored["_schema"]}
+    assert stored["L0"] == [{"_missing": ["required"],
+                             "name": "Name",
+                             "value": "One"}]
+    assert stored["L1"] == [{"description": "Changed",
+                             "name": "Colour",
+                             "parent": "Name"}]
+    assert stored["L2"] == [{"name": "Blue", "parent": "Name/Colour"}]
+    
+    # Records are rehydrated without the schema and stay referenced
+    with JSONDataBase(str(db_path)) as db:
+        records = db.to_records()
+        db.insert(make_record("Three", "Blue"))
+    
+    assert records[1] == record
+    assert records[2] == other
+    assert "_schema" in json.loads(db_path.read_text())["_default"]["3"]
+    
+    with JSONDataBase(str(db_path), referenced=False) as db:
+        db.flush()
+    
+    data = json.loads(db_path.read_text())
+    
+    assert "_schemas" not in data
+    assert data["_default"]["1"] == _order_data(record.to_dict())
@@ -0,0 +1,191 @@
+import json
+import pickle
+
+import pytest
+from anytree.resolver import ChildResolverError
+
+from taxonopy.schema import CompactNode, RecordView, SCHTree, get_node_path
+
+
+def test_tree_find_by_path(make_record):
+    
+    record = make_record("One", "Blue", ["Defrost", "Reheat"])
+    
+    reheat = record.find_by_path("/Name/Features/Reheat")
+    assert record.find_by_path("Name/Features/Reheat") is reheat
+    
+    record.move_node("Name/Features/Reheat", "Name/Colour")
+    
+    assert record.find_by_path("Name/Colour/Reheat") is reheat
+    with pytest.raises(ChildResolverError):
+        record.find_by_path("Name/Features/Reheat")
+    
+    record.update_node("Name/Colour", name="Color")
+    
+    assert get_node_path(record.find_by_path("Name/Color/Reheat")) == \
+                                                        "/Name/Color/Reheat"
+    with pytest.raises(ChildResolverError):
+        record.find_by_path("Name/Colour/Blue")
+    
+    # Nodes moved outside of the tree are still found at their new path
+    defrost = record.find_by_path("Name/Features/Defrost")
+    defrost.parent = record.root_node
+    
+    assert record.find_by_path("Name/Defrost") is defrost
+    with pytest.raises(ChildResolverError):
+        record.find_by_path("Name/Features/Defrost")
+    
+    record.delete_node("Name/Color")
+    
+    with pytest.raises(ChildResolverError):
+        record.find_by_path("Name/Color/Blue")
+
+
+def test_tree_from_dict(make_record):
+    
+    record = make_record("One", "Blue", ["Defrost", "Reheat"])
+    data = record.to_dict()
+    expected = json.dumps(data)
+    
+    tree = SCHTree.from_dict(data)
+    
+    assert json.dumps(data) == expected
+    assert tree == record
+    assert tree.find_by_path("Name/Features/Reheat").parent.inquire == \
+                                                                    "checkbox"
+    
+    prefixed = {key.replace("L", "X"): value for key, value in data.items()}
+    tree = SCHTree.from_dict(prefixed, level_prefix="X")
+    
+    assert tree.prefix == "X"
+    assert tree == record
+
+
+def test_tree_diff(make_record):
+    
+    record = make_record("One", "Blue", ["Defrost", "Reheat"])
+    other = make_record("Two", "Blue", ["Defrost", "Bluetooth"])
+    other.update_node("Name/Features", inquire="list")
+    
+    assert record.diff(other, detail=True) == {
+                "/Name": ("changed", ("value",)),
+                "/Name/Features": ("changed", ("inquire",)),
+                "/Name/Features/Reheat": ("deleted", ()),
+                "/Name/Features/Bluetooth": ("added", ())}
+    assert other.diff(record)["/Name/Features/Reheat"] == "added"
+    assert record.diff(SCHTree.from_dict(record.to_dict())) == {}
+
+
+def test_tree_hash(make_record):
+    
+    record = make_record("One", "Blue", ["Defrost", "Reheat"])
+    other = SCHTree.from_dict(record.to_dict())
+    
+    root_hash = record.get_hash()
+    colour_hash = record.get_hash("Name/Colour")
+    
+    assert other.get_hash() == root_hash
+    assert other == record
+    
+    record.add_node("Bluetooth", "Name/Features")
+    
+    assert record.get_hash() != root_hash
+    assert record.get_hash("Name/Colour") == colour_hash
+    assert other.diff(record) == {"/Name/Features/Bluetooth": "added"}
+    
+    record.update_node("Name/Colour/Blue", value="Navy")
+    
+    assert record.get_hash("Name/Colour") != colour_hash
+    
+    record.delete_node("Name/Features/Bluetooth")
+    record.update_node("Name/Colour/Blue", value=None)
+    
+    assert record.get_hash("Name/Features") == \
+                                            other.get_hash("Name/Features")
+    assert record != other
+
+
+def test_record_view_hash(make_record):
+    
+    record = make_record("One", "Blue", ["Defrost", "Reheat"])
+    view = RecordView(record.to_dict())
+    
+    assert view.get_hash() == record.get_hash()
+    assert view.get_hash("Name/Features") == record.get_hash("Name/Features")
+    
+    record.add_node("Bluetooth", "Name/Features")
+    other = RecordView(record.to_dict())
+    
+    assert other.get_hash() == record.get_hash()
+    assert other.get_hash() != view.get_hash()
+    assert other != view
+    assert RecordView({}).get_hash() is None
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_tree_hash_direct_changes(compact, make_record):
+    
+    record = make_record("One", "Blue", ["Defrost", "Reheat"])
+    record = SCHTree.from_dict(record.to_dict(), compact=compact)
+    other = SCHTree.from_dict(record.to_dict(), compact=compact)
+    
+    # Both hashes are cached by the comparison
+    assert record == other
+    
+    record.find_by_path("Name/Colour/Blue").value = "Navy"
+    
+    assert record != other
+    assert record.diff(other) == {"/Name/Colour/Blue": "changed"}
+    
+    record.find_by_path("Name/Features/Reheat").name = "Grill"
+    
+    assert record.diff(other) == {"/Name/Colour/Blue": "changed",
+                                  "/Name/Features/Grill": "deleted",
+                                  "/Name/Features/Reheat": "added"}
+    
+    other = SCHTree.from_dict(record.to_dict(), compact=compact)
+    assert record == other
+    
+    record.find_by_path("Name/Features/Grill").parent = \
+                                            record.find_by_path("Name/Colour")
+    
+    assert record.diff(other) == {"/Name/Colour/Grill": "deleted",
+                                  "/Name/Features/Grill": "added"}
+    
+    record.find_by_path("Name/Features").children = []
+    
+    assert record.diff(other)["/Name/Features/Defrost"] == "added"
+
+
+def test_compact_tree(make_record):
+    
+    record = make_record("One", "Blue", ["Defrost", "Reheat"])
+    compact = SCHTree.from_dict(record.to_dict(), compact=True)
+    
+    assert isinstance(compact.root_node, CompactNode)
+    assert str(compact) == str(record)
+    assert compact.to_dict() == record.to_dict()
+    assert compact == record
+    assert compact.get_hash() == record.get_hash()
+    
+    node = compact.find_by_path("Name/Features/Reheat")
+    
+    assert get_node_path(node) == "/Name/Features/Reheat"
+    assert node.parent.inquire == "checkbox"
+    assert node.depth == 2
+    assert not hasattr(node, "value")
+    
+    compact.add_node("Bluetooth", "Name/Features")
+    compact.update_node("Name/Colour/Blue", shade="Navy")
+    compact.delete_node("Name/Features/Defrost")
+    
+    assert [child.name for child in compact.find_by_path(
+                    "Name/Features").children] == ["Reheat", "Bluetooth"]
+    assert compact.find_by_path("Name/Colour/Blue").shade == "Navy"
+    assert set(compact.diff(record)) == {"/Name/Features/Bluetooth",
+                                         "/Name/Features/Defrost"}
+    
+    copied = pickle.loads(pickle.dumps(compact))
+    
+    assert copied.to_dict() == compact.to_dict()
+    assert copied.find_by_path("Name/Colour/Blue").shade == "Navy"